@@ -0,0 +1,924 @@
+# Almacén de datos del bot: una interfaz de repositorio (usuarios, salas, asientos,
+# manos y libro de fichas) con tres implementaciones intercambiables por configuración:
+# el fichero SQLite de siempre, memoria pura (pruebas y benchmarks) y un servidor
+# PostgreSQL compartido entre varios workers. Cada sala lleva en su fila la versión de su
+# estado (state_version): toda escritura la sube y la de una mano en juego solo se aplica
+# si la sala sigue en la versión que se leyó, así dos workers no pisan la misma mesa.
+import os
+import time
+import sqlite3
+from array import array
+from contextlib import contextmanager
+
+# Columnas de game_rooms y su valor en una sala recién creada
+SALA_NUEVA = {
+    'creator_id': 0,
+    'status': 'waiting',
+    'current_players': 1,
+    'max_players': 2,
+    'players': '',
+    'player_names': '',
+    'private_cards': '',
+    'community_cards': '',
+    'pot': 0,
+    'current_bet': 0,
+    'current_turn': 0,
+    'round': 'preflop',
+    'player_actions': '',
+    'player_folded': '',
+    'last_activity': 0.0,
+    'deck': '',
+    'deck_salt': '',
+    'deck_commit': '',
+    'dealer_seat': 0,
+    'turn_seat': 0,
+    'folded_mask': 0,
+    'allin_mask': 0,
+    'acted_mask': 0,
+    'seat_bets': '',
+    'seat_contrib': '',
+    'tournament_id': 0,
+    'state_version': 0,
+}
+
+# Versión del esquema SQL: con la base ya en esta versión, inicializar no ejecuta DDL.
+# Subirla con cada cambio de tablas, columnas o índices.
+VERSION_ESQUEMA = 4
+
+class ErrorAlmacen(Exception):
+    pass
+
+# La sala ya no está en la versión leída: otra escritura (quizá de otro worker) llegó antes
+class SalaCambiada(ErrorAlmacen):
+    pass
+
+# Interfaz común; las salas se leen y escriben como diccionarios columna -> valor
+class Almacen:
+    # Mantenimiento seguro en un hilo aparte (las implementaciones SQL abren su propia conexión)
+    en_hilo = False
+
+    def __init__(self):
+        self._profundidad = 0
+        self._tras_confirmar = []
+
+    # Agrupa varias escrituras en una sola transacción (anidable)
+    @contextmanager
+    def transaccion(self):
+        if self._profundidad == 0:
+            self._empezar()
+        self._profundidad += 1
+        try:
+            yield self
+        except BaseException:
+            self._profundidad -= 1
+            if self._profundidad == 0:
+                self._tras_confirmar = []
+                self._deshacer()
+            raise
+        self._profundidad -= 1
+        if self._profundidad == 0:
+            pendientes, self._tras_confirmar = self._tras_confirmar, []
+            self._confirmar()
+            for funcion in pendientes:
+                funcion()
+
+    # Ejecuta `funcion` cuando se confirme la transacción en curso (en el acto si no hay
+    # ninguna); si se deshace o falla el commit, no se ejecuta
+    def al_confirmar(self, funcion):
+        if self._profundidad:
+            self._tras_confirmar.append(funcion)
+        else:
+            funcion()
+
+    def _empezar(self):
+        pass
+
+    def _confirmar(self):
+        pass
+
+    def _deshacer(self):
+        pass
+
+    def inicializar(self):
+        pass
+
+    def cerrar(self):
+        pass
+
+    # Usuarios: {user_id: (username, chips)} solo con los que existen
+    def obtener_usuarios(self, user_ids):
+        raise NotImplementedError
+
+    def crear_usuario(self, user_id, username, chips):
+        raise NotImplementedError
+
+    # [(user_id, username, chips)] de todos los usuarios
+    def listar_usuarios(self):
+        raise NotImplementedError
+
+    # Libro de fichas: aplica [(user_id, delta, motivo, room_id)] y deja un asiento por movimiento
+    def mover_fichas(self, movimientos):
+        raise NotImplementedError
+
+    # Salas
+    def crear_sala(self, campos):
+        raise NotImplementedError
+
+    def obtener_sala(self, room_id):
+        return self.obtener_salas([room_id]).get(int(room_id))
+
+    def obtener_salas(self, room_ids):
+        raise NotImplementedError
+
+    def actualizar_sala(self, room_id, campos):
+        self.actualizar_salas({room_id: campos})
+
+    def actualizar_salas(self, cambios):
+        raise NotImplementedError
+
+    # Estado de una mano: solo si la sala sigue en `version`; devuelve la versión nueva
+    # o lanza SalaCambiada sin escribir nada
+    def guardar_estado(self, room_id, version, campos):
+        raise NotImplementedError
+
+    # [(room_id, current_players, max_players)] de las salas en espera
+    def salas_en_espera(self):
+        raise NotImplementedError
+
+    # Ids de las salas con una mano empezada o en juego ('starting' y 'playing')
+    def salas_en_juego(self):
+        raise NotImplementedError
+
+    # Asientos: sienta al usuario en la sala indicada (o en la primera libre) si sigue en
+    # espera y con sitio; devuelve la sala o None
+    def sentar(self, user_id, username, room_id=None):
+        raise NotImplementedError
+
+    # Manos terminadas: copia el estado final de la sala al historial con todos los que
+    # cobraron (de mayor a menor premio; winner_id es el primero)
+    def archivar_mano(self, room_id, ganadores, pot):
+        raise NotImplementedError
+
+    # Inscripciones de torneos sin liquidar: se borran al pagar el premio o devolverlas
+    def inscribir_torneo(self, torneo_id, user_id, inscripcion):
+        raise NotImplementedError
+
+    # [(torneo_id, user_id, inscripcion)] de todos los torneos sin liquidar
+    def inscripciones_torneo(self):
+        raise NotImplementedError
+
+    def liquidar_torneo(self, torneo_id):
+        raise NotImplementedError
+
+    # Mantenimiento acotado en tiempo: archiva salas en espera o cerradas inactivas; devuelve cuántas
+    def paso_mantenimiento(self, inactivas_desde, lote, limite, paginas_vacuum, analizar):
+        raise NotImplementedError
+
+def _lista(texto):
+    return texto.split(',') if texto else []
+
+# Salas sin mano en curso ('waiting' y 'closed') guardadas por columnas en arrays
+# indexados por room_id: creador, asientos ocupados y máximos, última actividad, versión
+# del estado y dos referencias (jugadores y nombres). Solo las salas con mano en juego tienen el
+# diccionario completo de columnas; al volver a esperar o cerrarse se compactan.
+# Las consultas no recorren todos los ids creados: un registro de escrituras en orden
+# de actividad y una cola de salas en espera con sitio, ambos en arrays; las entradas
+# que dejaron de valer se descartan al llegar a la cabeza.
+class SalasCompactas:
+    ESTADOS = (None, 'waiting', 'closed')
+    # Entradas descartadas a partir de las que se recortan el registro y la cola
+    RECORTE = 4096
+
+    def __init__(self):
+        self.estado = array('b')
+        self.creador = array('q')
+        self.ocupados = array('b')
+        self.maximo = array('b')
+        self.actividad = array('d')
+        self.version = array('q')
+        # None en jugadores = solo el creador (el caso de casi todas las salas en espera)
+        self.jugadores = []
+        self.nombres = []
+        self.total = 0
+        # Registro: (sala, escritura) en orden; vale si es la última escritura de una sala viva
+        self.escrituras = array('I')
+        self._registro_salas = array('q')
+        self._registro_escrituras = array('I')
+        self._registro_cabeza = 0
+        # Cola de salas con sitio; en_cola evita duplicados mientras siguen dentro
+        self.en_cola = array('b')
+        self._cola = array('q')
+        self._cola_cabeza = 0
+
+    def __contains__(self, room_id):
+        return room_id < len(self.estado) and self.estado[room_id] != 0
+
+    def __len__(self):
+        return self.total
+
+    def _crecer(self, room_id):
+        falta = room_id + 1 - len(self.estado)
+        if falta > 0:
+            # Crece a bloques para no copiar los arrays en cada sala nueva
+            falta = max(falta, len(self.estado) // 2, 64)
+            for columna in (self.estado, self.creador, self.ocupados, self.maximo, self.actividad,
+                            self.version, self.escrituras, self.en_cola):
+                columna.extend(bytes(falta))
+            self.jugadores.extend([None] * falta)
+            self.nombres.extend([None] * falta)
+
+    def guardar(self, room_id, sala):
+        self._crecer(room_id)
+        if not self.estado[room_id]:
+            self.total += 1
+        creador = sala['creator_id']
+        self.estado[room_id] = self.ESTADOS.index(sala['status'])
+        self.creador[room_id] = creador
+        self.ocupados[room_id] = sala['current_players']
+        self.maximo[room_id] = sala['max_players']
+        self.actividad[room_id] = sala['last_activity']
+        self.version[room_id] = sala['state_version']
+        self.jugadores[room_id] = None if sala['players'] == str(creador) else sala['players']
+        self.nombres[room_id] = sala['player_names']
+
+        # last_activity es la hora de la escritura: el registro queda en orden de actividad
+        self.escrituras[room_id] = (self.escrituras[room_id] + 1) & 0xFFFFFFFF
+        self._registro_salas.append(room_id)
+        self._registro_escrituras.append(self.escrituras[room_id])
+        if self._libre(room_id) and not self.en_cola[room_id]:
+            self.en_cola[room_id] = 1
+            self._cola.append(room_id)
+
+    def quitar(self, room_id):
+        if room_id in self:
+            self.estado[room_id] = 0
+            self.jugadores[room_id] = self.nombres[room_id] = None
+            self.total -= 1
+
+    # La sala como diccionario completo (columnas de la mano con su valor inicial)
+    def sala(self, room_id):
+        jugadores = self.jugadores[room_id]
+        return dict(SALA_NUEVA, room_id=room_id, creator_id=self.creador[room_id],
+                    status=self.ESTADOS[self.estado[room_id]], current_players=self.ocupados[room_id],
+                    max_players=self.maximo[room_id], last_activity=self.actividad[room_id],
+                    state_version=self.version[room_id],
+                    players=str(self.creador[room_id]) if jugadores is None else jugadores,
+                    player_names=self.nombres[room_id])
+
+    def _libre(self, room_id):
+        return self.estado[room_id] == 1 and self.ocupados[room_id] < self.maximo[room_id]
+
+    def _vigente(self, i):
+        room_id = self._registro_salas[i]
+        return self.estado[room_id] != 0 and self.escrituras[room_id] == self._registro_escrituras[i]
+
+    # Salas vivas por orden de actividad (la más antigua primero)
+    def _registro(self):
+        while self._registro_cabeza < len(self._registro_salas) and not self._vigente(self._registro_cabeza):
+            self._registro_cabeza += 1
+        if self._registro_cabeza >= self.RECORTE and self._registro_cabeza * 2 >= len(self._registro_salas):
+            del self._registro_salas[:self._registro_cabeza]
+            del self._registro_escrituras[:self._registro_cabeza]
+            self._registro_cabeza = 0
+        for i in range(self._registro_cabeza, len(self._registro_salas)):
+            if self._vigente(i):
+                yield self._registro_salas[i]
+
+    def en_espera(self):
+        return [(r, self.ocupados[r], self.maximo[r]) for r in self._registro() if self.estado[r] == 1]
+
+    # La sala que lleva más tiempo en la cola con sitio libre
+    def con_sitio(self):
+        while self._cola_cabeza < len(self._cola) and not self._libre(self._cola[self._cola_cabeza]):
+            self.en_cola[self._cola[self._cola_cabeza]] = 0
+            self._cola_cabeza += 1
+        if self._cola_cabeza >= self.RECORTE and self._cola_cabeza * 2 >= len(self._cola):
+            del self._cola[:self._cola_cabeza]
+            self._cola_cabeza = 0
+        return self._cola[self._cola_cabeza] if self._cola_cabeza < len(self._cola) else None
+
+    # Hasta `lote` salas sin actividad desde `desde`, las más antiguas primero
+    def inactivas(self, desde, lote):
+        expiradas = []
+        for room_id in self._registro():
+            if len(expiradas) >= lote or self.actividad[room_id] >= desde:
+                break
+            expiradas.append(room_id)
+        return expiradas
+
+# Implementación en memoria: diccionarios en el proceso, sin persistencia.
+# Las salas viven en dos niveles: SalasCompactas mientras esperan y un diccionario
+# solo mientras hay mano en juego.
+class AlmacenMemoria(Almacen):
+    def __init__(self):
+        super().__init__()
+        self.usuarios = {}
+        self.salas = {}
+        self.compactas = SalasCompactas()
+        self.libro = []
+        self.manos = []
+        self.archivo = {}
+        self.inscripciones = {}
+        self._siguiente_sala = 1
+
+    def obtener_usuarios(self, user_ids):
+        return {u: self.usuarios[u] for u in (int(x) for x in user_ids) if u in self.usuarios}
+
+    def crear_usuario(self, user_id, username, chips):
+        self.usuarios[int(user_id)] = (username, chips)
+
+    def listar_usuarios(self):
+        return [(u, nombre, fichas) for u, (nombre, fichas) in self.usuarios.items()]
+
+    def mover_fichas(self, movimientos):
+        ahora = time.time()
+        for user_id, delta, motivo, room_id in movimientos:
+            user_id = int(user_id)
+            if user_id in self.usuarios:
+                nombre, fichas = self.usuarios[user_id]
+                self.usuarios[user_id] = (nombre, fichas + delta)
+            self.libro.append((user_id, delta, motivo, room_id, ahora))
+
+    # Pasa la sala al nivel que le toca según su estado
+    def _colocar(self, sala):
+        room_id = sala['room_id']
+        if sala['status'] in SalasCompactas.ESTADOS:
+            self.salas.pop(room_id, None)
+            self.compactas.guardar(room_id, sala)
+        else:
+            self.compactas.quitar(room_id)
+            self.salas[room_id] = sala
+
+    def _sala(self, room_id):
+        sala = self.salas.get(room_id)
+        if sala is None and room_id in self.compactas:
+            sala = self.compactas.sala(room_id)
+        return sala
+
+    def crear_sala(self, campos):
+        room_id = self._siguiente_sala
+        self._siguiente_sala += 1
+        sala = dict(SALA_NUEVA, **campos)
+        sala['room_id'] = room_id
+        sala['last_activity'] = time.time()
+        self._colocar(sala)
+        return room_id
+
+    def obtener_salas(self, room_ids):
+        salas = {}
+        for room_id in (int(x) for x in room_ids):
+            sala = self._sala(room_id)
+            if sala is not None:
+                salas[room_id] = dict(sala)
+        return salas
+
+    def actualizar_salas(self, cambios):
+        ahora = time.time()
+        for room_id, campos in cambios.items():
+            sala = self._sala(int(room_id))
+            if sala is not None:
+                version = sala['state_version']
+                sala.update(campos)
+                sala['last_activity'] = ahora
+                sala['state_version'] = version + 1
+                self._colocar(sala)
+
+    def guardar_estado(self, room_id, version, campos):
+        sala = self._sala(int(room_id))
+        if sala is None or sala['state_version'] != version:
+            raise SalaCambiada(f"Sala {room_id} ya no está en la versión {version}")
+        self.actualizar_salas({room_id: campos})
+        return version + 1
+
+    def salas_en_espera(self):
+        return self.compactas.en_espera()
+
+    def salas_en_juego(self):
+        return [r for r, s in self.salas.items() if s['status'] in ('starting', 'playing')]
+
+    def sentar(self, user_id, username, room_id=None):
+        if room_id is None:
+            room_id = self.compactas.con_sitio()
+            if room_id is None:
+                return None
+        sala = self._sala(int(room_id))
+        if sala is None or sala['status'] != 'waiting' or sala['current_players'] >= sala['max_players']:
+            return None
+        self.actualizar_sala(sala['room_id'], {
+            'current_players': sala['current_players'] + 1,
+            'players': ','.join(_lista(sala['players']) + [str(user_id)]),
+            'player_names': ','.join(_lista(sala['player_names']) + [username]),
+        })
+        return self.obtener_sala(sala['room_id'])
+
+    def archivar_mano(self, room_id, ganadores, pot):
+        sala = self._sala(int(room_id))
+        if sala is not None:
+            self.manos.append((sala['room_id'], sala['players'], sala['player_names'], sala['private_cards'],
+                               sala['community_cards'], pot, int(ganadores[0]) if ganadores else 0,
+                               ','.join(str(g) for g in ganadores), time.time()))
+
+    def inscribir_torneo(self, torneo_id, user_id, inscripcion):
+        self.inscripciones[(int(torneo_id), int(user_id))] = inscripcion
+
+    def inscripciones_torneo(self):
+        return [(t, u, inscripcion) for (t, u), inscripcion in self.inscripciones.items()]
+
+    def liquidar_torneo(self, torneo_id):
+        for clave in [c for c in self.inscripciones if c[0] == int(torneo_id)]:
+            del self.inscripciones[clave]
+
+    # Las salas que se pueden archivar ('waiting' y 'closed') son justo las compactas
+    def paso_mantenimiento(self, inactivas_desde, lote, limite, paginas_vacuum, analizar):
+        ahora = time.time()
+        archivadas = 0
+        while time.monotonic() < limite:
+            expiradas = self.compactas.inactivas(inactivas_desde, lote)
+            if not expiradas:
+                break
+            for room_id in expiradas:
+                sala = self.compactas.sala(room_id)
+                self.compactas.quitar(room_id)
+                self.archivo[room_id] = (sala['creator_id'], 'expired', sala['players'], sala['player_names'],
+                                         sala['last_activity'], ahora)
+            archivadas += len(expiradas)
+        return archivadas
+
+# Base de las implementaciones SQL: las consultas se escriben con '?' y cada motor
+# traduce el marcador y las pocas sentencias que difieren entre dialectos
+class AlmacenSQL(Almacen):
+    en_hilo = True
+    marcador = '?'
+    errores_ocupado = ()
+
+    def __init__(self):
+        super().__init__()
+        self._conn = None
+
+    def _conectar(self):
+        raise NotImplementedError
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = self._conectar()
+        return self._conn
+
+    def _sql(self, sql):
+        return sql if self.marcador == '?' else sql.replace('?', self.marcador)
+
+    def _ejecutar(self, sql, params=(), conn=None):
+        c = (conn or self.conn).cursor()
+        c.execute(self._sql(sql), params)
+        return c
+
+    def _escribir(self, sql, params=()):
+        with self.transaccion():
+            return self._ejecutar(sql, params)
+
+    def _confirmar(self):
+        self.conn.commit()
+
+    def _deshacer(self):
+        self.conn.rollback()
+
+    def cerrar(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _sala(self, cursor, fila):
+        return dict(zip((d[0] for d in cursor.description), fila))
+
+    def obtener_usuarios(self, user_ids):
+        ids = [int(u) for u in user_ids]
+        if not ids:
+            return {}
+        c = self._ejecutar("SELECT user_id, username, chips FROM users WHERE user_id IN (" + ",".join(["?"]*len(ids)) + ")", ids)
+        return {user_id: (username, fichas) for user_id, username, fichas in c.fetchall()}
+
+    def crear_usuario(self, user_id, username, chips):
+        self._escribir("INSERT INTO users (user_id, username, chips) VALUES (?, ?, ?)", (int(user_id), username, chips))
+
+    def listar_usuarios(self):
+        return self._ejecutar("SELECT user_id, username, chips FROM users ORDER BY chips DESC").fetchall()
+
+    def mover_fichas(self, movimientos):
+        if not movimientos:
+            return
+        ahora = time.time()
+        with self.transaccion():
+            c = self.conn.cursor()
+            c.executemany(self._sql("UPDATE users SET chips = chips + ? WHERE user_id=?"),
+                          [(delta, int(user_id)) for user_id, delta, _, _ in movimientos])
+            c.executemany(self._sql("INSERT INTO chip_ledger (user_id, delta, reason, room_id, created_at) VALUES (?, ?, ?, ?, ?)"),
+                          [(int(user_id), delta, motivo, room_id, ahora) for user_id, delta, motivo, room_id in movimientos])
+
+    def _insertar_sala(self, columnas, valores):
+        raise NotImplementedError
+
+    def crear_sala(self, campos):
+        campos = dict(campos, last_activity=time.time())
+        columnas = [k for k in campos if k in SALA_NUEVA]
+        with self.transaccion():
+            return self._insertar_sala(columnas, [campos[k] for k in columnas])
+
+    def obtener_salas(self, room_ids):
+        ids = [int(r) for r in room_ids]
+        if not ids:
+            return {}
+        c = self._ejecutar("SELECT * FROM game_rooms WHERE room_id IN (" + ",".join(["?"]*len(ids)) + ")", ids)
+        salas = [self._sala(c, fila) for fila in c.fetchall()]
+        return {s['room_id']: s for s in salas}
+
+    def actualizar_salas(self, cambios):
+        ahora = time.time()
+        with self.transaccion():
+            for room_id, campos in cambios.items():
+                columnas = [k for k in campos if k in SALA_NUEVA and k not in ('last_activity', 'state_version')]
+                self._ejecutar("UPDATE game_rooms SET " + "".join(f"{k}=?, " for k in columnas) +
+                               "state_version = state_version + 1, last_activity=? WHERE room_id=?",
+                               [campos[k] for k in columnas] + [ahora, int(room_id)])
+
+    # UPDATE condicional sobre state_version: si otro worker escribió antes no cambia ninguna fila
+    def guardar_estado(self, room_id, version, campos):
+        columnas = [k for k in campos if k in SALA_NUEVA and k not in ('last_activity', 'state_version')]
+        with self.transaccion():
+            c = self._ejecutar("UPDATE game_rooms SET " + "".join(f"{k}=?, " for k in columnas) +
+                               "state_version = state_version + 1, last_activity=? WHERE room_id=? AND state_version=?",
+                               [campos[k] for k in columnas] + [time.time(), int(room_id), version])
+            if c.rowcount != 1:
+                raise SalaCambiada(f"Sala {room_id} ya no está en la versión {version}")
+        return version + 1
+
+    def salas_en_espera(self):
+        return self._ejecutar("SELECT room_id, current_players, max_players FROM game_rooms WHERE status='waiting'").fetchall()
+
+    def salas_en_juego(self):
+        return [fila[0] for fila in self._ejecutar("SELECT room_id FROM game_rooms WHERE status IN ('starting', 'playing')")]
+
+    # Primera sala con sitio (PostgreSQL salta las que otro worker está ocupando)
+    SQL_SALA_LIBRE = "SELECT room_id FROM game_rooms WHERE status='waiting' AND current_players < max_players ORDER BY room_id LIMIT 1"
+
+    # Un solo UPDATE condicional: dos workers no pueden ocupar el mismo último asiento
+    def sentar(self, user_id, username, room_id=None):
+        with self.transaccion():
+            c = self._ejecutar("UPDATE game_rooms SET current_players = current_players + 1, "
+                               "players = CASE WHEN players = '' THEN ? ELSE players || ',' || ? END, "
+                               "player_names = CASE WHEN player_names = '' THEN ? ELSE player_names || ',' || ? END, "
+                               "last_activity = ? "
+                               "WHERE room_id = " + ("(" + self.SQL_SALA_LIBRE + ")" if room_id is None else "?") +
+                               " AND status='waiting' AND current_players < max_players RETURNING *",
+                               [str(user_id), str(user_id), username, username, time.time()] +
+                               ([] if room_id is None else [int(room_id)]))
+            fila = c.fetchone()
+            return self._sala(c, fila) if fila else None
+
+    def archivar_mano(self, room_id, ganadores, pot):
+        self._escribir("INSERT INTO hand_history (room_id, players, player_names, private_cards, community_cards, pot, winner_id, winners, finished_at) "
+                       "SELECT room_id, players, player_names, private_cards, community_cards, ?, ?, ?, ? FROM game_rooms WHERE room_id=?",
+                       (pot, int(ganadores[0]) if ganadores else 0, ','.join(str(g) for g in ganadores), time.time(), int(room_id)))
+
+    def inscribir_torneo(self, torneo_id, user_id, inscripcion):
+        self._escribir("INSERT INTO tournament_entries (tournament_id, user_id, buyin) VALUES (?, ?, ?)",
+                       (int(torneo_id), int(user_id), inscripcion))
+
+    def inscripciones_torneo(self):
+        return self._ejecutar("SELECT tournament_id, user_id, buyin FROM tournament_entries").fetchall()
+
+    def liquidar_torneo(self, torneo_id):
+        self._escribir("DELETE FROM tournament_entries WHERE tournament_id=?", (int(torneo_id),))
+
+    # Sentencia que copia las salas expiradas al archivo (difiere en el manejo de duplicados)
+    SQL_ARCHIVAR = None
+
+    # En PostgreSQL compacta el autovacuum del servidor
+    def _compactar(self, conn, paginas_vacuum, analizar):
+        pass
+
+    def paso_mantenimiento(self, inactivas_desde, lote, limite, paginas_vacuum, analizar):
+        ahora = time.time()
+        archivadas = 0
+        # Conexión propia: corre en un hilo aparte del bucle del bot
+        try:
+            conn = self._conectar(timeout=1)
+        except self.errores_ocupado as e:
+            raise ErrorAlmacen(str(e))
+        try:
+            while time.monotonic() < limite:
+                c = self._ejecutar("SELECT room_id FROM game_rooms WHERE status IN ('waiting', 'closed') AND last_activity < ? LIMIT ?",
+                                   (inactivas_desde, lote), conn)
+                ids = [fila[0] for fila in c.fetchall()]
+                if not ids:
+                    break
+                # Se repiten las condiciones: una sala que volvió a jugar entre la selección
+                # y el borrado se queda donde está
+                filtro = (" WHERE room_id IN (" + ",".join(["?"]*len(ids)) + ") "
+                          "AND status IN ('waiting', 'closed') AND last_activity < ?")
+                self._ejecutar(self.SQL_ARCHIVAR + " FROM game_rooms" + filtro, [ahora] + ids + [inactivas_desde], conn)
+                c = self._ejecutar("DELETE FROM game_rooms" + filtro, ids + [inactivas_desde], conn)
+                conn.commit()
+                archivadas += c.rowcount
+
+            if time.monotonic() < limite:
+                self._compactar(conn, paginas_vacuum, analizar)
+        except self.errores_ocupado as e:
+            # Base ocupada: lo archivado hasta aquí ya está confirmado
+            raise ErrorAlmacen(str(e))
+        finally:
+            conn.close()
+        return archivadas
+
+# El fichero SQLite local de siempre
+class AlmacenSQLite(AlmacenSQL):
+    errores_ocupado = (sqlite3.OperationalError,)
+    SQL_ARCHIVAR = ("INSERT OR REPLACE INTO game_rooms_archive (room_id, creator_id, status, players, player_names, last_activity, archived_at) "
+                    "SELECT room_id, creator_id, 'expired', players, player_names, last_activity, ?")
+
+    def __init__(self, ruta):
+        super().__init__()
+        self.ruta = ruta
+
+    def _conectar(self, timeout=5):
+        return sqlite3.connect(self.ruta, timeout=timeout)
+
+    def _insertar_sala(self, columnas, valores):
+        c = self._ejecutar("INSERT INTO game_rooms (" + ", ".join(columnas) + ") VALUES (" + ", ".join(["?"]*len(columnas)) + ")", valores)
+        return c.lastrowid
+
+    def _compactar(self, conn, paginas_vacuum, analizar):
+        conn.execute(f"PRAGMA incremental_vacuum({paginas_vacuum})").fetchall()
+        if analizar:
+            conn.execute("PRAGMA analysis_limit=400")
+            conn.execute("PRAGMA optimize")
+
+    def inicializar(self):
+        c = self.conn.cursor()
+        # Esquema ya al día (PRAGMA user_version): arranque sin DDL ni comprobaciones
+        if c.execute("PRAGMA user_version").fetchone()[0] == VERSION_ESQUEMA:
+            return
+        c.execute('''CREATE TABLE IF NOT EXISTS users
+                     (user_id INTEGER PRIMARY KEY, username TEXT, chips INTEGER DEFAULT 1000)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS game_rooms
+                     (room_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      creator_id INTEGER,
+                      status TEXT DEFAULT 'waiting',
+                      current_players INTEGER DEFAULT 1,
+                      max_players INTEGER DEFAULT 2,
+                      players TEXT DEFAULT '',
+                      player_names TEXT DEFAULT '',
+                      private_cards TEXT DEFAULT '',
+                      community_cards TEXT DEFAULT '',
+                      pot INTEGER DEFAULT 0,
+                      current_bet INTEGER DEFAULT 0,
+                      current_turn INTEGER DEFAULT 0,
+                      round TEXT DEFAULT 'preflop',
+                      player_actions TEXT DEFAULT '',
+                      player_folded TEXT DEFAULT '')''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_chips ON users (chips DESC)")
+
+        # Columnas añadidas después de la versión inicial
+        columnas = [fila[1] for fila in c.execute("PRAGMA table_info(game_rooms)")]
+        if 'last_activity' not in columnas:
+            c.execute("ALTER TABLE game_rooms ADD COLUMN last_activity REAL")
+            c.execute("UPDATE game_rooms SET last_activity=strftime('%s','now')")
+        for columna in ('deck', 'deck_salt', 'deck_commit'):
+            if columna not in columnas:
+                c.execute(f"ALTER TABLE game_rooms ADD COLUMN {columna} TEXT DEFAULT ''")
+        for columna in ('dealer_seat', 'turn_seat', 'folded_mask', 'allin_mask', 'acted_mask'):
+            if columna not in columnas:
+                c.execute(f"ALTER TABLE game_rooms ADD COLUMN {columna} INTEGER DEFAULT 0")
+        for columna in ('seat_bets', 'seat_contrib'):
+            if columna not in columnas:
+                c.execute(f"ALTER TABLE game_rooms ADD COLUMN {columna} TEXT DEFAULT ''")
+        if 'tournament_id' not in columnas:
+            c.execute("ALTER TABLE game_rooms ADD COLUMN tournament_id INTEGER DEFAULT 0")
+        if 'state_version' not in columnas:
+            c.execute("ALTER TABLE game_rooms ADD COLUMN state_version INTEGER DEFAULT 0")
+
+        # Actividad de salas para expirar las abandonadas (la escribe actualizar_salas en todos los motores)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_game_rooms_status ON game_rooms (status, last_activity)")
+        c.execute("DROP TRIGGER IF EXISTS trg_game_rooms_insert")
+        c.execute("DROP TRIGGER IF EXISTS trg_game_rooms_update")
+
+        # Archivo frío de salas expiradas y manos terminadas
+        c.execute('''CREATE TABLE IF NOT EXISTS game_rooms_archive
+                     (room_id INTEGER PRIMARY KEY,
+                      creator_id INTEGER,
+                      status TEXT,
+                      players TEXT,
+                      player_names TEXT,
+                      last_activity REAL,
+                      archived_at REAL)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS hand_history
+                     (hand_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      room_id INTEGER,
+                      players TEXT,
+                      player_names TEXT,
+                      private_cards TEXT,
+                      community_cards TEXT,
+                      pot INTEGER,
+                      winner_id INTEGER,
+                      winners TEXT DEFAULT '',
+                      finished_at REAL)''')
+        if 'winners' not in [fila[1] for fila in c.execute("PRAGMA table_info(hand_history)")]:
+            c.execute("ALTER TABLE hand_history ADD COLUMN winners TEXT DEFAULT ''")
+
+        # Libro de fichas: cada movimiento con su motivo
+        c.execute('''CREATE TABLE IF NOT EXISTS chip_ledger
+                     (entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      user_id INTEGER,
+                      delta INTEGER,
+                      reason TEXT,
+                      room_id INTEGER,
+                      created_at REAL)''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chip_ledger_user ON chip_ledger (user_id, entry_id)")
+
+        # Inscripciones pagadas de torneos aún sin premio ni devolución
+        c.execute('''CREATE TABLE IF NOT EXISTS tournament_entries
+                     (tournament_id INTEGER,
+                      user_id INTEGER,
+                      buyin INTEGER,
+                      PRIMARY KEY (tournament_id, user_id))''')
+        self.conn.commit()
+
+        # Vacuum incremental (cambiar el modo requiere un VACUUM completo una sola vez)
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            c.execute("VACUUM")
+        c.execute(f"PRAGMA user_version={VERSION_ESQUEMA}")
+
+# Servidor PostgreSQL compartido (psycopg2 es opcional: solo hace falta con este motor)
+class AlmacenPostgres(AlmacenSQL):
+    marcador = '%s'
+    SQL_SALA_LIBRE = AlmacenSQL.SQL_SALA_LIBRE + " FOR UPDATE SKIP LOCKED"
+    SQL_ARCHIVAR = ("INSERT INTO game_rooms_archive (room_id, creator_id, status, players, player_names, last_activity, archived_at) "
+                    "SELECT room_id, creator_id, 'expired', players, player_names, last_activity, ?")
+
+    def __init__(self, url):
+        super().__init__()
+        if not url:
+            raise ErrorAlmacen("POKER_BACKEND=postgres requiere DATABASE_URL")
+        self.url = url
+
+    def _conectar(self, timeout=5):
+        try:
+            import psycopg2
+        except ImportError:
+            raise ErrorAlmacen("POKER_BACKEND=postgres requiere el paquete psycopg2 (pip install psycopg2-binary)")
+        self.errores_ocupado = (psycopg2.OperationalError,)
+        return psycopg2.connect(self.url, connect_timeout=max(int(timeout), 1))
+
+    # Conexión del bot en autocommit: las lecturas sueltas no dejan la conexión
+    # "idle in transaction" y transaccion() abre la suya con BEGIN
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = self._conectar()
+            self._conn.autocommit = True
+        return self._conn
+
+    def _empezar(self):
+        self._ejecutar("BEGIN")
+
+    def _confirmar(self):
+        self._ejecutar("COMMIT")
+
+    def _deshacer(self):
+        self._ejecutar("ROLLBACK")
+
+    def _insertar_sala(self, columnas, valores):
+        c = self._ejecutar("INSERT INTO game_rooms (" + ", ".join(columnas) + ") VALUES (" + ", ".join(["?"]*len(columnas)) + ") "
+                           "RETURNING room_id", valores)
+        return c.fetchone()[0]
+
+    def inicializar(self):
+        with self.transaccion():
+            # Esquema ya al día: arranque sin DDL
+            if self._ejecutar("SELECT to_regclass('schema_version')").fetchone()[0] is not None and \
+                    self._ejecutar("SELECT MAX(version) FROM schema_version").fetchone()[0] == VERSION_ESQUEMA:
+                return
+            for sql in ('''CREATE TABLE IF NOT EXISTS users
+                           (user_id BIGINT PRIMARY KEY, username TEXT, chips BIGINT DEFAULT 1000)''',
+                        '''CREATE TABLE IF NOT EXISTS game_rooms
+                           (room_id SERIAL PRIMARY KEY,
+                            creator_id BIGINT,
+                            status TEXT DEFAULT 'waiting',
+                            current_players INTEGER DEFAULT 1,
+                            max_players INTEGER DEFAULT 2,
+                            players TEXT DEFAULT '',
+                            player_names TEXT DEFAULT '',
+                            private_cards TEXT DEFAULT '',
+                            community_cards TEXT DEFAULT '',
+                            pot BIGINT DEFAULT 0,
+                            current_bet BIGINT DEFAULT 0,
+                            current_turn BIGINT DEFAULT 0,
+                            round TEXT DEFAULT 'preflop',
+                            player_actions TEXT DEFAULT '',
+                            player_folded TEXT DEFAULT '',
+                            last_activity DOUBLE PRECISION,
+                            deck TEXT DEFAULT '',
+                            deck_salt TEXT DEFAULT '',
+                            deck_commit TEXT DEFAULT '',
+                            dealer_seat INTEGER DEFAULT 0,
+                            turn_seat INTEGER DEFAULT 0,
+                            folded_mask INTEGER DEFAULT 0,
+                            allin_mask INTEGER DEFAULT 0,
+                            acted_mask INTEGER DEFAULT 0,
+                            seat_bets TEXT DEFAULT '',
+                            seat_contrib TEXT DEFAULT '',
+                            tournament_id INTEGER DEFAULT 0,
+                            state_version BIGINT DEFAULT 0)''',
+                        "ALTER TABLE game_rooms ADD COLUMN IF NOT EXISTS tournament_id INTEGER DEFAULT 0",
+                        "ALTER TABLE game_rooms ADD COLUMN IF NOT EXISTS state_version BIGINT DEFAULT 0",
+                        "CREATE INDEX IF NOT EXISTS idx_users_chips ON users (chips DESC)",
+                        "CREATE INDEX IF NOT EXISTS idx_game_rooms_status ON game_rooms (status, last_activity)",
+                        '''CREATE TABLE IF NOT EXISTS game_rooms_archive
+                           (room_id INTEGER PRIMARY KEY,
+                            creator_id BIGINT,
+                            status TEXT,
+                            players TEXT,
+                            player_names TEXT,
+                            last_activity DOUBLE PRECISION,
+                            archived_at DOUBLE PRECISION)''',
+                        '''CREATE TABLE IF NOT EXISTS hand_history
+                           (hand_id SERIAL PRIMARY KEY,
+                            room_id INTEGER,
+                            players TEXT,
+                            player_names TEXT,
+                            private_cards TEXT,
+                            community_cards TEXT,
+                            pot BIGINT,
+                            winner_id BIGINT,
+                            winners TEXT DEFAULT '',
+                            finished_at DOUBLE PRECISION)''',
+                        "ALTER TABLE hand_history ADD COLUMN IF NOT EXISTS winners TEXT DEFAULT ''",
+                        '''CREATE TABLE IF NOT EXISTS chip_ledger
+                           (entry_id BIGSERIAL PRIMARY KEY,
+                            user_id BIGINT,
+                            delta BIGINT,
+                            reason TEXT,
+                            room_id INTEGER,
+                            created_at DOUBLE PRECISION)''',
+                        "CREATE INDEX IF NOT EXISTS idx_chip_ledger_user ON chip_ledger (user_id, entry_id)",
+                        '''CREATE TABLE IF NOT EXISTS tournament_entries
+                           (tournament_id INTEGER,
+                            user_id BIGINT,
+                            buyin BIGINT,
+                            PRIMARY KEY (tournament_id, user_id))''',
+                        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)",
+                        "DELETE FROM schema_version"):
+                self._ejecutar(sql)
+            self._ejecutar("INSERT INTO schema_version (version) VALUES (?)", (VERSION_ESQUEMA,))
+
+# Motor elegido por entorno: POKER_BACKEND=sqlite (por defecto) | memoria | postgres
+def crear_almacen(tipo=None):
+    tipo = (tipo or os.getenv('POKER_BACKEND', 'sqlite')).lower()
+    if tipo == 'sqlite':
+        return AlmacenSQLite(os.getenv('POKER_DB_PATH', 'poker.db'))
+    if tipo == 'memoria':
+        return AlmacenMemoria()
+    if tipo == 'postgres':
+        return AlmacenPostgres(os.getenv('DATABASE_URL'))
+    raise ErrorAlmacen(f"POKER_BACKEND desconocido: {tipo}")
+
+# ---------- Medición de memoria ----------
+
+# Bytes por sala en espera: n salas recién creadas en el almacén en memoria frente a
+# las mismas salas como diccionarios completos (la representación anterior)
+def medir_salas(n):
+    import tracemalloc
+
+    almacen = AlmacenMemoria()
+    for user_id in range(1, n + 1):
+        almacen.crear_usuario(user_id, f"J{user_id}", 1000)
+    nombres = [almacen.usuarios[u][0] for u in range(1, n + 1)]
+
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    for user_id, nombre in enumerate(nombres, 1):
+        almacen.crear_sala({'creator_id': user_id, 'players': str(user_id), 'player_names': nombre})
+    compactas = tracemalloc.get_traced_memory()[0] - antes
+
+    antes = tracemalloc.get_traced_memory()[0]
+    diccionarios = {}
+    for user_id, nombre in enumerate(nombres, 1):
+        diccionarios[user_id] = dict(SALA_NUEVA, room_id=user_id, creator_id=user_id, players=str(user_id),
+                                     player_names=nombre, last_activity=time.time())
+    completas = tracemalloc.get_traced_memory()[0] - antes
+    tracemalloc.stop()
+
+    if len(almacen.salas_en_espera()) != n:
+        raise AssertionError("Faltan salas en espera")
+    return compactas / n, completas / n
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Memoria por sala en espera del almacén en memoria")
+    parser.add_argument('--salas', type=int, default=100000)
+    args = parser.parse_args()
+
+    compacta, completa = medir_salas(args.salas)
+    print(f"{args.salas} salas en espera: {compacta:.0f} bytes/sala compactas, {completa:.0f} bytes/sala "
+          f"como diccionario ({compacta * args.salas / 2**20:.1f} MB frente a {completa * args.salas / 2**20:.1f} MB)")
@@ -0,0 +1,303 @@
+# Evaluador de manos y tablas de equidad precalculadas.
+# equidad.bin se genera una sola vez (python equidad.py --generar) y se abre con mmap la
+# primera vez que se consulta: no cuesta nada al arrancar, todos los procesos que lo
+# abren comparten las mismas páginas y cada consulta es un índice fijo en el fichero.
+#
+# Formato (little-endian): cabecera "EQT2" + dimensiones, luego equidades en uint16
+# (0..65535 = 0..100%):
+#   preflop[169 manos iniciales][8 rivales]
+#   flop[6 texturas][43 clases de mano][8 rivales]
+import os
+import sys
+import mmap
+import random
+import struct
+import time
+from array import array
+
+RUTA_TABLAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'equidad.bin')
+
+MAX_RIVALES = 8
+MANOS_INICIALES = 169
+TEXTURAS = ['arcoíris', 'dos palos', 'monocolor', 'doblada arcoíris', 'doblada dos palos', 'doblada monocolor']
+CATEGORIAS = ['Carta alta', 'Pareja', 'Doble pareja', 'Trío', 'Escalera', 'Color', 'Full', 'Póker', 'Escalera de color']
+# Clases de mano en el flop por categoría: carta alta según cuántas cartas propias
+# superan a la mesa (0, 1, 2) y pareja según su lugar respecto a la mesa; ambas, además,
+# con su proyecto (ninguno, escalera abierta, color, ambos). Con doble pareja o trío en
+# el flop no cabe proyecto.
+SUBCLASES_FLOP = [3, 6, 1, 1, 1, 1, 1, 1, 1]
+PROYECTOS_FLOP = [4, 4, 1, 1, 1, 1, 1, 1, 1]
+PAREJAS_FLOP = ['Sobrepareja', 'Pareja alta con buen acompañante', 'Pareja alta', 'Pareja media', 'Pareja baja',
+                'Pareja en la mesa']
+_PRIMERA_CLASE = [sum(s * p for s, p in zip(SUBCLASES_FLOP[:cat], PROYECTOS_FLOP[:cat])) for cat in range(len(CATEGORIAS))]
+CLASES_FLOP = _PRIMERA_CLASE[-1] + SUBCLASES_FLOP[-1] * PROYECTOS_FLOP[-1]
+# Acompañante de la pareja alta que cuenta como bueno: J o más
+ACOMPANANTE_BUENO = 9
+
+CABECERA = struct.Struct('<4sHHHH')
+MAGIA = b'EQT2'
+ESCALA = 65535
+NOMBRES_RANGO = '23456789TJQKA'
+
+# Cartas: rango * 4 + palo, con rango 0 (el 2) .. 12 (el as)
+def carta(rango, palo):
+    return rango * 4 + palo
+
+# ---------- Evaluador ----------
+
+# (máscara de rangos, carta alta) de cada escalera, de la más alta a la rueda A-5
+_ESCALERAS = [(0x1F << (alta - 4), alta) for alta in range(12, 3, -1)] + [(0x100F, 3)]
+
+def _escalera(mascara):
+    for patron, alta in _ESCALERAS:
+        if mascara & patron == patron:
+            return alta
+    return -1
+
+# Categoría en los bits altos y hasta cinco rangos de desempate de 4 bits
+def _valor(categoria, rangos):
+    v = categoria
+    for r in rangos:
+        v = (v << 4) | r
+    return v << 4 * (5 - len(rangos))
+
+def categoria(valor):
+    return valor >> 20
+
+# Valor comparable de la mejor mano de 5 cartas entre 5..7 (mayor gana, igual empata)
+def valor_mano(cartas):
+    cuentas = [0] * 13
+    palos = [0, 0, 0, 0]
+    for c in cartas:
+        cuentas[c >> 2] += 1
+        palos[c & 3] |= 1 << (c >> 2)
+
+    color = None
+    for m in palos:
+        if bin(m).count('1') >= 5:
+            alta = _escalera(m)
+            if alta >= 0:
+                return _valor(8, [alta])
+            color = _valor(5, [r for r in range(12, -1, -1) if m >> r & 1][:5])
+            break
+
+    rangos = [r for r in range(12, -1, -1) if cuentas[r]]
+    cuatro = [r for r in rangos if cuentas[r] == 4]
+    if cuatro:
+        return _valor(7, [cuatro[0], next(r for r in rangos if r != cuatro[0])])
+    tres = [r for r in rangos if cuentas[r] == 3]
+    pares = [r for r in rangos if cuentas[r] == 2]
+    if tres and (len(tres) > 1 or pares):
+        return _valor(6, [tres[0], max(tres[1:] + pares)])
+    if color is not None:
+        return color
+    alta = _escalera(sum(1 << r for r in rangos))
+    if alta >= 0:
+        return _valor(4, [alta])
+    if tres:
+        return _valor(3, [tres[0]] + [r for r in rangos if r != tres[0]][:2])
+    if len(pares) >= 2:
+        return _valor(2, pares[:2] + [r for r in rangos if r not in pares[:2]][:1])
+    if pares:
+        return _valor(1, [pares[0]] + [r for r in rangos if r != pares[0]][:3])
+    return _valor(0, rangos[:5])
+
+# ---------- Índices de las tablas ----------
+
+# 0..12 parejas, 13..90 del mismo palo, 91..168 de distinto palo
+def indice_inicial(c1, c2):
+    r1, r2 = c1 >> 2, c2 >> 2
+    if r1 < r2:
+        r1, r2 = r2, r1
+    if r1 == r2:
+        return r1
+    base = 13 if (c1 & 3) == (c2 & 3) else 91
+    return base + r1 * (r1 - 1) // 2 + r2
+
+# Una mano concreta de cada índice (para generar) y su nombre: AA, AKs, T9o...
+def representante(indice):
+    if indice < 13:
+        return carta(indice, 0), carta(indice, 1)
+    mismo_palo = indice < 91
+    resto = indice - (13 if mismo_palo else 91)
+    r1 = 1
+    while (r1 + 1) * r1 // 2 <= resto:
+        r1 += 1
+    r2 = resto - r1 * (r1 - 1) // 2
+    return carta(r1, 0), carta(r2, 0 if mismo_palo else 1)
+
+def nombre_inicial(indice):
+    c1, c2 = representante(indice)
+    nombre = NOMBRES_RANGO[c1 >> 2] + NOMBRES_RANGO[c2 >> 2]
+    if indice < 13:
+        return nombre
+    return nombre + ('s' if indice < 91 else 'o')
+
+def textura_flop(flop):
+    palos = len({c & 3 for c in flop})
+    doblada = len({c >> 2 for c in flop}) < 3
+    return (3 - palos) + (3 if doblada else 0)
+
+# Lugar de la mano respecto a la mesa dentro de su categoría (ver SUBCLASES_FLOP)
+def _subclase_flop(cat, mano, flop):
+    propias = sorted((c >> 2 for c in mano), reverse=True)
+    mesa = sorted({c >> 2 for c in flop}, reverse=True)
+    if cat == 0:
+        return sum(1 for r in propias if r > mesa[0])
+    if cat != 1:
+        return 0
+    if propias[0] == propias[1]:
+        if propias[0] > mesa[0]:
+            return 0
+        return 3 if propias[0] > mesa[1] else 4
+    emparejada = next((r for r in propias if r in mesa), None)
+    if emparejada is None:
+        return 5
+    if emparejada == mesa[0]:
+        acompanante = propias[1] if emparejada == propias[0] else propias[0]
+        return 1 if acompanante >= ACOMPANANTE_BUENO else 2
+    return 3 if emparejada == mesa[1] else 4
+
+# Clase de la mano con el flop: categoría, lugar respecto a la mesa y proyecto
+def clase_flop(mano, flop):
+    cartas = list(mano) + list(flop)
+    cat = categoria(valor_mano(cartas))
+    proyecto = 0
+    if PROYECTOS_FLOP[cat] > 1:
+        palos = [0, 0, 0, 0]
+        mascara = 0
+        for c in cartas:
+            palos[c & 3] += 1
+            mascara |= 1 << (c >> 2)
+        if any((mascara >> bajo) & 0xF == 0xF for bajo in range(10)):
+            proyecto |= 1
+        if max(palos) == 4:
+            proyecto |= 2
+    return _PRIMERA_CLASE[cat] + _subclase_flop(cat, mano, flop) * PROYECTOS_FLOP[cat] + proyecto
+
+_INICIO_FLOP = MANOS_INICIALES * MAX_RIVALES
+
+# ---------- Consulta ----------
+
+class TablasEquidad:
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._valores = None
+        self.disponible = True
+
+    # Se abre al primer uso; sin fichero las consultas devuelven None
+    def _tabla(self):
+        if self._valores is None and self.disponible:
+            try:
+                with open(self.ruta, 'rb') as f:
+                    mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                self.disponible = False
+                return None
+            magia, iniciales, rivales, clases, texturas = CABECERA.unpack_from(mapa)
+            if (magia, iniciales, rivales, clases, texturas) != (MAGIA, MANOS_INICIALES, MAX_RIVALES, CLASES_FLOP, len(TEXTURAS)):
+                self.disponible = False
+                return None
+            self._valores = memoryview(mapa)[CABECERA.size:].cast('H')
+        return self._valores
+
+    # Equidad (0..1) de dos cartas contra `rivales` manos al azar antes del flop
+    def inicial(self, c1, c2, rivales):
+        tabla = self._tabla()
+        if tabla is None or not 1 <= rivales <= MAX_RIVALES:
+            return None
+        return tabla[indice_inicial(c1, c2) * MAX_RIVALES + rivales - 1] / ESCALA
+
+    # Equidad media en el flop según la clase de la mano (con su lugar respecto a la
+    # mesa y su proyecto) y la textura del flop
+    def flop(self, mano, flop, rivales):
+        tabla = self._tabla()
+        if tabla is None or not 1 <= rivales <= MAX_RIVALES:
+            return None
+        fila = textura_flop(flop) * CLASES_FLOP + clase_flop(mano, flop)
+        return tabla[_INICIO_FLOP + fila * MAX_RIVALES + rivales - 1] / ESCALA
+
+# ---------- Generación ----------
+
+# Reparte la mesa y 8 rivales una vez por muestra y acumula la equidad contra los
+# primeros k rivales para k = 1..8 (empates repartidos)
+def _acumular(ganado, heroe_cartas, mesa, rivales_cartas):
+    heroe = valor_mano(heroe_cartas + mesa)
+    mejor = -1
+    empatados = 0
+    for k in range(MAX_RIVALES):
+        v = valor_mano(rivales_cartas[2 * k:2 * k + 2] + mesa)
+        if v > mejor:
+            mejor, empatados = v, 1
+        elif v == mejor:
+            empatados += 1
+        if heroe > mejor:
+            ganado[k] += 1
+        elif heroe == mejor:
+            ganado[k] += 1 / (empatados + 1)
+
+def generar(ruta, muestras_inicial=20000, muestras_flop=3000000, semilla=None, progreso=True):
+    rng = random.Random(semilla)
+    inicio = time.perf_counter()
+    preflop = []
+    for indice in range(MANOS_INICIALES):
+        c1, c2 = representante(indice)
+        resto = [c for c in range(52) if c not in (c1, c2)]
+        ganado = [0.0] * MAX_RIVALES
+        for _ in range(muestras_inicial):
+            cartas = rng.sample(resto, 5 + 2 * MAX_RIVALES)
+            _acumular(ganado, [c1, c2], cartas[:5], cartas[5:])
+        preflop.extend(g / muestras_inicial for g in ganado)
+        if progreso and indice % 13 == 12:
+            print(f"preflop {indice + 1}/{MANOS_INICIALES} ({time.perf_counter() - inicio:.0f}s)", file=sys.stderr)
+
+    filas = len(TEXTURAS) * CLASES_FLOP
+    ganado = [[0.0] * MAX_RIVALES for _ in range(filas)]
+    vistas = [0] * filas
+    for n in range(muestras_flop):
+        cartas = rng.sample(range(52), 2 + 5 + 2 * MAX_RIVALES)
+        mano, mesa = cartas[:2], cartas[2:7]
+        fila = textura_flop(mesa[:3]) * CLASES_FLOP + clase_flop(mano, mesa[:3])
+        _acumular(ganado[fila], mano, mesa, cartas[7:])
+        vistas[fila] += 1
+        if progreso and n % 50000 == 49999:
+            print(f"flop {n + 1}/{muestras_flop} ({time.perf_counter() - inicio:.0f}s)", file=sys.stderr)
+
+    flop = []
+    for fila in range(filas):
+        if vistas[fila]:
+            valores = [g / vistas[fila] for g in ganado[fila]]
+        elif fila % CLASES_FLOP:
+            # Clase imposible o no vista: la anterior de la misma textura
+            valores = flop[-MAX_RIVALES:]
+        else:
+            valores = [0.0] * MAX_RIVALES
+        flop.extend(valores)
+
+    datos = array('H', (min(round(v * ESCALA), ESCALA) for v in preflop + flop))
+    if sys.byteorder != 'little':
+        datos.byteswap()
+    with open(ruta, 'wb') as f:
+        f.write(CABECERA.pack(MAGIA, MANOS_INICIALES, MAX_RIVALES, CLASES_FLOP, len(TEXTURAS)))
+        f.write(datos.tobytes())
+    return time.perf_counter() - inicio
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tablas de equidad precalculadas")
+    parser.add_argument('--generar', action='store_true')
+    parser.add_argument('--ruta', default=RUTA_TABLAS)
+    parser.add_argument('--muestras', type=int, default=20000)
+    parser.add_argument('--muestras-flop', type=int, default=3000000)
+    parser.add_argument('--semilla', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.generar:
+        segundos = generar(args.ruta, args.muestras, args.muestras_flop, args.semilla)
+        print(f"{args.ruta}: {os.path.getsize(args.ruta)} bytes en {segundos:.0f}s")
+
+    tablas = TablasEquidad(args.ruta)
+    for indice in (12, 90, 168, 0, 91):
+        c1, c2 = representante(indice)
+        print(nombre_inicial(indice), ' '.join(f"{tablas.inicial(c1, c2, r):.3f}" for r in range(1, MAX_RIVALES + 1)))
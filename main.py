@@ -1,16 +1,28 @@
+import time
+# Referencia para el desglose del arranque (incluye importar telegram y el resto)
+ARRANQUE = time.perf_counter()
 import os
 import logging
-import random
 import asyncio
+import bisect
+import heapq
+import hashlib
+import secrets
+import math
+from collections import OrderedDict, deque
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-import sqlite3
+from telegram.error import RetryAfter
 
-# Configurar logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+import motor
+import torneo
+import perfil
+import equidad
+import registro
+from almacen import crear_almacen, ErrorAlmacen, SalaCambiada
+
+# Configurar logging (JSON por un hilo escritor, ver registro.py)
+registro.configurar()
 logger = logging.getLogger(__name__)
 
 # Mazo de cartas completo con emojis
@@ -18,30 +30,368 @@ SUITS = ['♠️', '♥️', '♦️', '♣️']
 RANKS = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
 DECK = [f"{rank}{suit}" for suit in SUITS for rank in RANKS]
 
-# Base de datos
+# Servicio de barajado: entropía CSPRNG en bloque y permutaciones pregeneradas
+SHUFFLE_BUFFER = int(os.getenv('SHUFFLE_BUFFER', '256'))
+SHUFFLE_BATCH = int(os.getenv('SHUFFLE_BATCH', '64'))
+
+class ServicioBarajado:
+    def __init__(self, capacidad, lote):
+        self.capacidad = capacidad
+        self.lote = lote
+        self.rng = secrets.SystemRandom()
+        self._buffer = deque(maxlen=capacidad)
+
+    # Genera un lote de permutaciones (Fisher-Yates) a partir de una sola lectura de os.urandom
+    def _rellenar(self):
+        n = len(DECK)
+        entropia = os.urandom(self.lote * n * 2)
+        pos = 0
+        for _ in range(min(self.lote, self.capacidad - len(self._buffer))):
+            indices = list(range(n))
+            for i in range(n - 1, 0, -1):
+                # Muestreo por rechazo sobre 16 bits para evitar sesgo de módulo
+                limite = 65536 - 65536 % (i + 1)
+                while True:
+                    if pos + 2 > len(entropia):
+                        entropia = os.urandom(self.lote * n * 2)
+                        pos = 0
+                    valor = entropia[pos] << 8 | entropia[pos + 1]
+                    pos += 2
+                    if valor < limite:
+                        break
+                j = valor % (i + 1)
+                indices[i], indices[j] = indices[j], indices[i]
+            self._buffer.append(indices)
+
+    # Devuelve (mazo, sal, compromiso) para una mano completa
+    def nueva_mano(self):
+        if not self._buffer:
+            self._rellenar()
+        mazo = [DECK[i] for i in self._buffer.popleft()]
+        sal = secrets.token_hex(16)
+        return mazo, sal, compromiso_mazo(mazo, sal)
+
+def compromiso_mazo(mazo, sal):
+    return hashlib.sha256(f"{sal}:{','.join(mazo)}".encode()).hexdigest()
+
+barajador = ServicioBarajado(SHUFFLE_BUFFER, SHUFFLE_BATCH)
+
+# Las cartas se reparten en orden desde la permutación de la mano
+def cartas_del_mazo(deck_str, cartas_usadas, n):
+    if deck_str:
+        orden = deck_str.split(',')
+        return orden[len(cartas_usadas):len(cartas_usadas) + n]
+    # Manos empezadas antes de existir el mazo guardado
+    mazo = [carta for carta in DECK if carta not in cartas_usadas]
+    barajador.rng.shuffle(mazo)
+    return mazo[:n]
+
+# Texto para verificar el compromiso publicado al empezar la mano (solo en el showdown)
+def revelar_mazo(deck_str, sal, compromiso):
+    if not deck_str or not sal:
+        return ""
+    return f"🔐 **Verificación del mazo**\n" \
+           f"Sal: {sal}\n" \
+           f"Mazo: {deck_str}\n" \
+           f"SHA-256(sal:mazo) = {compromiso}\n\n"
+
+# Versión del estado de cada sala (state_version de su fila) y jugador en turno, tal como
+# los vio este proceso por última vez. Los botones de juego llevan la versión con la que se
+# pintaron; la fila manda: con varios workers la caché puede ir por detrás y se relee
+# antes de rechazar un botón.
+versiones_sala = {}
+turnos_sala = {}
+
+def version_sala(room_id):
+    room_id = int(room_id)
+    if room_id not in versiones_sala:
+        refrescar_estado(room_id)
+    return versiones_sala.get(room_id, 0)
+
+def marcar_estado(room_id, current_turn, version):
+    room_id = int(room_id)
+    versiones_sala[room_id] = version
+    turnos_sala[room_id] = str(current_turn)
+
+def olvidar_estado(room_id):
+    versiones_sala.pop(int(room_id), None)
+    turnos_sala.pop(int(room_id), None)
+
+def refrescar_estado(room_id):
+    room = almacen.obtener_sala(room_id)
+    if room:
+        marcar_estado(room_id, room['current_turn'], room['state_version'])
+    else:
+        olvidar_estado(room_id)
+
+# Estado de una mesa en el motor a partir de su fila en game_rooms
+def _enteros(texto):
+    return [int(x) for x in texto.split(',')] if texto else []
+
+# Devuelve (players, mesa, sala) o None si la sala no existe
+def cargar_mesa(room_id):
+    room = almacen.obtener_sala(room_id)
+    if not room:
+        return None
+    
+    players = room['players'].split(',') if room['players'] else []
+    m = motor.Mesas(1)
+    for asiento, fichas in enumerate(fichas_en_mesa(room_id, players)):
+        m.fichas[asiento] = fichas
+    for asiento, apuesta in enumerate(_enteros(room['seat_bets'])):
+        m.apuestas[asiento] = apuesta
+    for asiento, aporte in enumerate(_enteros(room['seat_contrib'])):
+        m.aportes[asiento] = aporte
+    m.ocupados[0] = (1 << len(players)) - 1
+    m.boton[0] = room['dealer_seat'] or 0
+    m.turno[0] = room['turn_seat'] or 0
+    m.retirados[0] = room['folded_mask'] or 0
+    m.all_in[0] = room['allin_mask'] or 0
+    m.actuaron[0] = room['acted_mask'] or 0
+    m.bote[0] = room['pot'] or 0
+    m.apuesta_actual[0] = room['current_bet'] or 0
+    m.ronda[0] = motor.RONDAS.index(room['round']) if room['round'] in motor.RONDAS else 0
+    return players, m, room
+
+# Campos de la sala que reflejan el estado del motor (más los que se pasen en extra).
+# Solo se escriben si la sala sigue en `version`, la state_version con la que se leyó;
+# si no, SalaCambiada. Devuelve los campos escritos (con la versión nueva) para quien ya
+# tenga la sala en memoria. Con la mano cerrada (turno -1) deja current_turn=0 y marca
+# la sala sin nadie en turno.
+def guardar_mesa(room_id, players, m, version, **extra):
+    n = len(players)
+    turno = m.turno[0]
+    current_turn = int(players[turno]) if turno >= 0 else 0
+    campos = dict(
+        pot=m.bote[0], current_bet=m.apuesta_actual[0], round=motor.RONDAS[m.ronda[0]],
+        current_turn=current_turn, turn_seat=max(turno, 0), dealer_seat=m.boton[0],
+        folded_mask=m.retirados[0], allin_mask=m.all_in[0], acted_mask=m.actuaron[0],
+        seat_bets=','.join(str(x) for x in m.apuestas[:n]),
+        seat_contrib=','.join(str(x) for x in m.aportes[:n]), **extra)
+    campos['state_version'] = almacen.guardar_estado(room_id, version, campos)
+    # Con la transacción deshecha la caché seguiría en la versión que no llegó a escribirse
+    almacen.al_confirmar(lambda: marcar_estado(room_id, current_turn, campos['state_version']))
+    return campos
+
+# Almacén de datos (motor elegido con POKER_BACKEND)
+almacen = crear_almacen()
+
 def init_db():
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (user_id INTEGER PRIMARY KEY, username TEXT, chips INTEGER DEFAULT 1000)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS game_rooms
-                 (room_id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                  creator_id INTEGER, 
-                  status TEXT DEFAULT 'waiting',
-                  current_players INTEGER DEFAULT 1,
-                  max_players INTEGER DEFAULT 2,
-                  players TEXT DEFAULT '',
-                  player_names TEXT DEFAULT '',
-                  private_cards TEXT DEFAULT '',
-                  community_cards TEXT DEFAULT '',
-                  pot INTEGER DEFAULT 0,
-                  current_bet INTEGER DEFAULT 0,
-                  current_turn INTEGER DEFAULT 0,
-                  round TEXT DEFAULT 'preflop',
-                  player_actions TEXT DEFAULT '',
-                  player_folded TEXT DEFAULT '')''')
-    conn.commit()
-    conn.close()
+    almacen.inicializar()
+
+# Mantenimiento en segundo plano
+ROOM_IDLE_TIMEOUT = int(os.getenv('ROOM_IDLE_TIMEOUT', '1800'))
+MAINT_INTERVAL = int(os.getenv('MAINT_INTERVAL', '60'))
+MAINT_SLICE_MS = int(os.getenv('MAINT_SLICE_MS', '50'))
+MAINT_BATCH = int(os.getenv('MAINT_BATCH', '100'))
+MAINT_VACUUM_PAGES = int(os.getenv('MAINT_VACUUM_PAGES', '100'))
+MAINT_ANALYZE_EVERY = int(os.getenv('MAINT_ANALYZE_EVERY', '60'))
+
+_ciclos_mantenimiento = 0
+
+# Un paso acotado en tiempo: archiva salas expiradas por lotes, luego compacta la base
+def paso_mantenimiento():
+    global _ciclos_mantenimiento
+    _ciclos_mantenimiento += 1
+    return almacen.paso_mantenimiento(
+        time.time() - ROOM_IDLE_TIMEOUT,
+        MAINT_BATCH,
+        time.monotonic() + MAINT_SLICE_MS / 1000,
+        MAINT_VACUUM_PAGES,
+        _ciclos_mantenimiento % MAINT_ANALYZE_EVERY == 0)
+
+async def mantenimiento(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if almacen.en_hilo:
+            archivadas = await asyncio.to_thread(paso_mantenimiento)
+        else:
+            archivadas = paso_mantenimiento()
+        if archivadas:
+            logger.info(f"🧹 Mantenimiento: {archivadas} salas inactivas archivadas")
+    except ErrorAlmacen as e:
+        # Base ocupada: se reintenta en el siguiente ciclo
+        logger.warning("Mantenimiento pospuesto", extra=registro.con_error(e, action='mantenimiento'))
+
+# Caché de usuarios (LRU acotada con TTL y escritura directa de fichas)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+
+class CacheUsuarios:
+    def __init__(self, capacidad, ttl):
+        self.capacidad = capacidad
+        self.ttl = ttl
+        # user_id -> (username, chips, expira). username None = no registrado
+        self._datos = OrderedDict()
+
+    def obtener(self, user_id):
+        entrada = self._datos.get(user_id)
+        if entrada is None:
+            return None
+        if entrada[2] < time.monotonic():
+            del self._datos[user_id]
+            return None
+        self._datos.move_to_end(user_id)
+        return entrada
+
+    def guardar(self, user_id, username, chips):
+        self._datos[user_id] = (username, chips, time.monotonic() + self.ttl)
+        self._datos.move_to_end(user_id)
+        while len(self._datos) > self.capacidad:
+            self._datos.popitem(last=False)
+
+    def ajustar_fichas(self, user_id, delta):
+        entrada = self._datos.get(user_id)
+        if entrada is None or entrada[0] is None:
+            return
+        self._datos[user_id] = (entrada[0], entrada[1] + delta, entrada[2])
+
+cache_usuarios = CacheUsuarios(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Devuelve (username, chips) o None si el usuario no está registrado
+def obtener_usuario(user_id):
+    user_id = int(user_id)
+    entrada = cache_usuarios.obtener(user_id)
+    if entrada is not None:
+        return None if entrada[0] is None else (entrada[0], entrada[1])
+    return precargar_usuarios([user_id]).get(user_id)
+
+# Carga en una sola consulta los usuarios que no estén en caché
+def precargar_usuarios(user_ids):
+    ids = [int(u) for u in user_ids if u != '']
+    resultado = {}
+    faltan = []
+    for u in ids:
+        entrada = cache_usuarios.obtener(u)
+        if entrada is None:
+            faltan.append(u)
+        else:
+            resultado[u] = None if entrada[0] is None else (entrada[0], entrada[1])
+    if faltan:
+        encontrados = almacen.obtener_usuarios(faltan)
+        for u in faltan:
+            user = encontrados.get(u)
+            cache_usuarios.guardar(u, *(user or (None, None)))
+            resultado[u] = user
+    return resultado
+
+# Ranking de fichas: lista ordenada de (-chips, user_id) mantenida incrementalmente.
+# Se carga entero en la primera consulta, no al arrancar; hasta entonces los cambios
+# de fichas no hace falta seguirlos porque la carga ya los lee del almacén.
+RANKING_TOP = 10
+
+class IndiceRanking:
+    def __init__(self, top, cargador):
+        self.top = top
+        self.cargador = cargador
+        self.cargado = False
+        self._orden = []
+        self._fichas = {}
+        self._nombres = {}
+        self._render_top = None
+
+    def _asegurar(self):
+        if not self.cargado:
+            self.cargar(self.cargador())
+
+    def cargar(self, filas):
+        self._fichas = {user_id: fichas for user_id, _, fichas in filas}
+        self._nombres = {user_id: username for user_id, username, _ in filas}
+        self._orden = sorted((-fichas, user_id) for user_id, fichas in self._fichas.items())
+        self._render_top = None
+        self.cargado = True
+
+    def actualizar(self, user_id, username, fichas):
+        if not self.cargado:
+            return
+        anterior = self._fichas.get(user_id)
+        if anterior is not None:
+            pos = bisect.bisect_left(self._orden, (-anterior, user_id))
+            del self._orden[pos]
+            if pos < self.top:
+                self._render_top = None
+        nueva = bisect.bisect_left(self._orden, (-fichas, user_id))
+        self._orden.insert(nueva, (-fichas, user_id))
+        if nueva < self.top:
+            self._render_top = None
+        self._fichas[user_id] = fichas
+        if username is not None:
+            self._nombres[user_id] = username
+
+    def ajustar(self, user_id, delta):
+        fichas = self._fichas.get(user_id)
+        if fichas is not None:
+            self.actualizar(user_id, None, fichas + delta)
+
+    # Posición 1-based del jugador, o None si no está registrado
+    def posicion(self, user_id):
+        self._asegurar()
+        fichas = self._fichas.get(user_id)
+        if fichas is None:
+            return None
+        return bisect.bisect_left(self._orden, (-fichas, user_id)) + 1
+
+    def total(self):
+        self._asegurar()
+        return len(self._orden)
+
+    def render_top(self):
+        self._asegurar()
+        if self._render_top is None:
+            lineas = []
+            medallas = {1: '🥇', 2: '🥈', 3: '🥉'}
+            for i, (menos_fichas, user_id) in enumerate(self._orden[:self.top], start=1):
+                nombre = self._nombres.get(user_id) or "Jugador"
+                lineas.append(f"{medallas.get(i, f'{i}.')} {nombre}: {-menos_fichas} fichas")
+            self._render_top = "\n".join(lineas)
+        return self._render_top
+
+ranking = IndiceRanking(RANKING_TOP, lambda: almacen.listar_usuarios())
+
+# Registrar usuario nuevo (escritura directa en caché)
+def registrar_usuario(user_id, username, fichas=1000):
+    almacen.crear_usuario(user_id, username, fichas)
+    cache_usuarios.guardar(int(user_id), username, fichas)
+    ranking.actualizar(int(user_id), username, fichas)
+
+# Sumar/restar fichas en bloque: [(user_id, delta)] con su motivo en el libro
+# (caché y ranking se ajustan cuando la transacción se confirma, nunca si se deshace)
+def cambiar_fichas(movimientos, motivo, room_id=None):
+    movimientos = [(int(user_id), delta) for user_id, delta in movimientos if delta]
+    room_id = int(room_id) if room_id is not None else None
+    almacen.mover_fichas([(user_id, delta, motivo, room_id) for user_id, delta in movimientos])
+    
+    def ajustar():
+        for user_id, delta in movimientos:
+            cache_usuarios.ajustar_fichas(user_id, delta)
+            ranking.ajustar(user_id, delta)
+    almacen.al_confirmar(ajustar)
+
+# Torneos en curso (en memoria, como los relojes y los espectadores; las inscripciones
+# pagadas quedan en el almacén hasta el premio o la devolución)
+TOURNEY_TABLE_SIZE = min(max(int(os.getenv('TOURNEY_TABLE_SIZE', '6')), torneo.MESA_MINIMA), motor.MAX_ASIENTOS)
+TOURNEY_STACK = int(os.getenv('TOURNEY_STACK', '1500'))
+TOURNEY_BUYIN = int(os.getenv('TOURNEY_BUYIN', '100'))
+TOURNEY_LEVEL_SECS = int(os.getenv('TOURNEY_LEVEL_SECS', '300'))
+
+torneos = {}
+torneo_de_mesa = {}
+
+# Fichas en juego de cada asiento: las del torneo o el saldo del usuario
+def fichas_en_mesa(room_id, players):
+    t = torneo_de_mesa.get(int(room_id))
+    if t:
+        return [t.fichas.get(int(p), 0) for p in players]
+    usuarios = precargar_usuarios(players)
+    return [max(usuarios[int(p)][1], 0) if usuarios.get(int(p)) else 0 for p in players]
+
+# Movimientos de fichas de una mano: van al torneo o al saldo (con su asiento en el libro)
+def pagar_en_mesa(room_id, movimientos, motivo):
+    t = torneo_de_mesa.get(int(room_id))
+    if t:
+        for user_id, delta in movimientos:
+            t.fichas[int(user_id)] += delta
+    else:
+        cambiar_fichas(movimientos, motivo, room_id)
 
 # Comando /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -53,7 +403,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/unirse - Únete a una sala de poker\n"
         "/crear_sala - Crea una nueva sala\n"
         "/salas - Muestra salas disponibles\n"
-        "/chips - Muestra tus fichas\n\n"
+        "/chips - Muestra tus fichas\n"
+        "/ranking - Top de jugadores por fichas\n"
+        "/mirar [sala] - Mira una mesa en vivo\n"
+        "/torneo - Torneos multimesa\n\n"
         "⚠️ ¡ALERTA! Al unirte 2 jugadores, el juego comienza AUTOMÁTICAMENTE!"
     )
 
@@ -67,39 +420,27 @@ async def registro_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = args[0]
     user_id = update.effective_user.id
     
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    if c.fetchone():
+    if obtener_usuario(user_id):
         await update.message.reply_text(f"✅ Ya estás registrado como {username}!")
     else:
-        c.execute("INSERT INTO users (user_id, username, chips) VALUES (?, ?, 1000)",
-                 (user_id, username))
-        conn.commit()
+        registrar_usuario(user_id, username)
         await update.message.reply_text(f"✅ Registrado como {username} con 1000 fichas!")
-    
-    conn.close()
 
-# Mostrar mesa con cartas y estado
-async def mostrar_mesa(room_id, context):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT community_cards, pot, round, players, player_names, current_turn, current_bet FROM game_rooms WHERE room_id=?", (room_id,))
-    room = c.fetchone()
+# Mostrar mesa con cartas y estado (con la sala ya leída si se pasa)
+async def mostrar_mesa(room_id, context, room=None):
+    if room is None:
+        room = almacen.obtener_sala(room_id)
     
     if not room:
-        conn.close()
         return ""
     
-    community = room[0] or ""
-    pot = room[1]
-    ronda = room[2]
-    players = room[3].split(',') if room[3] else []
-    player_names = room[4].split(',') if room[4] else []
-    current_turn = room[5]
-    current_bet = room[6]
+    community = room['community_cards'] or ""
+    pot = room['pot']
+    ronda = room['round']
+    players = room['players'].split(',') if room['players'] else []
+    player_names = room['player_names'].split(',') if room['player_names'] else []
+    current_turn = str(room['current_turn'])
+    current_bet = room['current_bet']
     
     # Nombre de la ronda
     nombres_ronda = {
@@ -151,212 +492,550 @@ async def mostrar_mesa(room_id, context):
             else:
                 mensaje += f"• {name}\n"
     
-    conn.close()
     return mensaje
 
-# Enviar mesa con botones CORREGIDO
-async def enviar_mesa_con_botones(room_id, context, user_id_actual=None):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
+# Cola de salida por chat: fusiona mensajes cercanos y prioriza los turnos
+PRIORIDAD_TURNO = 0
+PRIORIDAD_MESA = 1
+PRIORIDAD_INFO = 2
+OUTBOX_COALESCE_MS = int(os.getenv('OUTBOX_COALESCE_MS', '300'))
+
+class ColaSalida:
+    def __init__(self, ventana):
+        self.ventana = ventana
+        # chat_id -> {'info': [textos], 'mesa': (texto, markup) o None, 'prioridad': int}
+        self._pendientes = {}
+        self._heap = []
+        self._seq = 0
+        self._despertar = None
+        self._tarea = None
+
+    def _programar(self, chat_id, prioridad, plazo):
+        self._seq += 1
+        heapq.heappush(self._heap, (plazo, prioridad, self._seq, chat_id))
+        if self._tarea is None or self._tarea.done():
+            self._despertar = asyncio.Event()
+            self._tarea = asyncio.get_running_loop().create_task(self._despachar())
+        self._despertar.set()
+
+    def _pendiente(self, bot, chat_id, room_id=None):
+        pendiente = self._pendientes.get(chat_id)
+        if pendiente is None:
+            pendiente = {'bot': bot, 'info': [], 'mesa': None, 'prioridad': PRIORIDAD_INFO, 'trazas': [], 'room_id': None}
+            self._pendientes[chat_id] = pendiente
+        if room_id is not None:
+            pendiente['room_id'] = int(room_id)
+        # El envío cuenta como etapa de la acción que lo generó
+        traza = perfil.traza_actual.get()
+        if traza is not None:
+            traza.retener()
+            pendiente['trazas'].append(traza)
+        return pendiente
+
+    # Mensaje informativo: se fusiona con lo que llegue dentro de la ventana
+    def encolar_info(self, bot, chat_id, texto, room_id=None):
+        pendiente = self._pendiente(bot, chat_id, room_id)
+        pendiente['info'].append(texto)
+        self._programar(chat_id, pendiente['prioridad'], asyncio.get_running_loop().time() + self.ventana)
+
+    # Estado de mesa: reemplaza cualquier estado anterior aún no enviado.
+    # `inmediato` lo saca sin esperar la ventana (el inicio de mano sale a todos a la vez)
+    def encolar_mesa(self, bot, chat_id, texto, reply_markup, en_turno=False, room_id=None, inmediato=False):
+        pendiente = self._pendiente(bot, chat_id, room_id)
+        pendiente['mesa'] = (texto, reply_markup)
+        ahora = asyncio.get_running_loop().time()
+        if en_turno:
+            pendiente['prioridad'] = PRIORIDAD_TURNO
+            self._programar(chat_id, PRIORIDAD_TURNO, ahora)
+        else:
+            pendiente['prioridad'] = min(pendiente['prioridad'], PRIORIDAD_MESA)
+            self._programar(chat_id, pendiente['prioridad'], ahora if inmediato else ahora + self.ventana)
+
+    async def _enviar(self, chat_id, pendiente):
+        textos = list(pendiente['info'])
+        reply_markup = None
+        if pendiente['mesa']:
+            textos.append(pendiente['mesa'][0])
+            reply_markup = pendiente['mesa'][1]
+        try:
+            await pendiente['bot'].send_message(
+                chat_id=chat_id,
+                text="\n\n".join(textos),
+                reply_markup=reply_markup
+            )
+        except Exception as e:
+            accion = pendiente['trazas'][0].accion if pendiente['trazas'] else None
+            logger.warning("Error enviando a %s", chat_id,
+                           extra=registro.con_error(e, user_id=chat_id, room_id=pendiente['room_id'], action=accion))
+        for traza in pendiente['trazas']:
+            traza.soltar(f"envío a {chat_id}")
+
+    async def _despachar(self):
+        # La tarea hereda el contexto de quien la creó; no pertenece a ninguna acción
+        perfil.traza_actual.set(None)
+        loop = asyncio.get_running_loop()
+        while self._heap:
+            plazo = self._heap[0][0]
+            espera = plazo - loop.time()
+            if espera > 0:
+                self._despertar.clear()
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), espera)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            # Todo lo vencido sale junto, los turnos primero
+            ahora = loop.time()
+            listos = []
+            while self._heap and self._heap[0][0] <= ahora:
+                listos.append(heapq.heappop(self._heap))
+            listos.sort(key=lambda entrada: (entrada[1], entrada[2]))
+            envios = []
+            for _, _, _, chat_id in listos:
+                pendiente = self._pendientes.pop(chat_id, None)
+                if pendiente:
+                    envios.append(self._enviar(chat_id, pendiente))
+            if envios:
+                await asyncio.gather(*envios)
+
+cola_salida = ColaSalida(OUTBOX_COALESCE_MS / 1000)
+
+# Rueda de temporizadores jerárquica: armar/cancelar en O(1), un solo reloj para todas las mesas
+TURN_TIMEOUT = int(os.getenv('TURN_TIMEOUT', '60'))
+TURN_WARNINGS = [int(x) for x in os.getenv('TURN_WARNINGS', '30,10').split(',') if x]
+TIMER_TICK = float(os.getenv('TIMER_TICK', '0.5'))
+
+class RuedaTemporizadores:
+    def __init__(self, tick, tamanos=(256, 64, 64)):
+        self.tick = tick
+        self.tamanos = tamanos
+        # Ticks que cubre cada hueco de cada nivel
+        self.alcances = [1]
+        for tamano in tamanos[:-1]:
+            self.alcances.append(self.alcances[-1] * tamano)
+        self.niveles = [[{} for _ in range(tamano)] for tamano in tamanos]
+        self._inicio = time.monotonic()
+        self._actual = 0
+        # clave -> [vence, dato, nivel, hueco]
+        self._entradas = {}
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def _colocar(self, clave, entrada):
+        diferencia = entrada[0] - self._actual
+        nivel = len(self.tamanos) - 1
+        for i, tamano in enumerate(self.tamanos):
+            if diferencia < self.alcances[i] * tamano:
+                nivel = i
+                break
+        hueco = (entrada[0] // self.alcances[nivel]) % self.tamanos[nivel]
+        entrada[2] = nivel
+        entrada[3] = hueco
+        self.niveles[nivel][hueco][clave] = entrada
+
+    def armar(self, clave, retraso, dato=None):
+        self.cancelar(clave)
+        vence = self._actual + max(1, math.ceil(retraso / self.tick))
+        entrada = [vence, dato, 0, 0]
+        self._entradas[clave] = entrada
+        self._colocar(clave, entrada)
+
+    def cancelar(self, clave):
+        entrada = self._entradas.pop(clave, None)
+        if entrada is not None:
+            del self.niveles[entrada[2]][entrada[3]][clave]
+
+    # Avanza hasta el instante dado y devuelve [(clave, dato)] vencidos
+    def avanzar(self, ahora=None):
+        ahora = time.monotonic() if ahora is None else ahora
+        objetivo = int((ahora - self._inicio) / self.tick)
+        vencidos = []
+        while self._actual < objetivo:
+            self._actual += 1
+            # Bajar de nivel los huecos que empiezan en este tick
+            for nivel in range(len(self.tamanos) - 1, 0, -1):
+                if self._actual % self.alcances[nivel] == 0:
+                    hueco = (self._actual // self.alcances[nivel]) % self.tamanos[nivel]
+                    pendientes = self.niveles[nivel][hueco]
+                    self.niveles[nivel][hueco] = {}
+                    for clave, entrada in pendientes.items():
+                        self._colocar(clave, entrada)
+            hueco = self.niveles[0][self._actual % self.tamanos[0]]
+            for clave in [k for k, entrada in hueco.items() if entrada[0] <= self._actual]:
+                entrada = hueco.pop(clave)
+                del self._entradas[clave]
+                vencidos.append((clave, entrada[1]))
+        return vencidos
+
+rueda_turnos = RuedaTemporizadores(TIMER_TICK)
+
+def armar_reloj_turno(room_id, player_id):
+    room_id = int(room_id)
+    rueda_turnos.armar(('turno', room_id), TURN_TIMEOUT, (room_id, player_id, None))
+    for restante in TURN_WARNINGS:
+        if 0 < restante < TURN_TIMEOUT:
+            rueda_turnos.armar(('aviso', room_id, restante), TURN_TIMEOUT - restante, (room_id, player_id, restante))
+
+def cancelar_reloj_turno(room_id):
+    room_id = int(room_id)
+    rueda_turnos.cancelar(('turno', room_id))
+    for restante in TURN_WARNINGS:
+        rueda_turnos.cancelar(('aviso', room_id, restante))
+
+# Aviso o acción automática (pasar si no hay apuesta, si no retirarse)
+async def turno_vencido(room_id, player_id, restante, context):
+    cargado = cargar_mesa(room_id)
+    if not cargado:
+        return
+    players, m, room = cargado
     
-    c.execute("SELECT players, current_turn, current_bet FROM game_rooms WHERE room_id=?", (room_id,))
-    room = c.fetchone()
+    if room['status'] != 'playing' or str(room['current_turn']) != player_id:
+        return
+    
+    if restante is not None:
+        cola_salida.encolar_info(context.bot, int(player_id), f"⏰ ¡Te quedan {restante} segundos para actuar!")
+        return
     
+    if motor.por_igualar(m, 0, players.index(player_id)) == 0:
+        cola_salida.encolar_info(context.bot, int(player_id), "⏰ Tiempo agotado: pasaste automáticamente.")
+        await jugar_accion(room_id, player_id, motor.PASAR, 0, room['state_version'], context)
+    else:
+        cola_salida.encolar_info(context.bot, int(player_id), "⏰ Tiempo agotado: te retiraste automáticamente.")
+        await jugar_accion(room_id, player_id, motor.RETIRARSE, 0, room['state_version'], context)
+
+async def reloj_turnos(context: ContextTypes.DEFAULT_TYPE):
+    for _, (room_id, player_id, restante) in rueda_turnos.avanzar():
+        context.application.create_task(turno_vencido(room_id, player_id, restante, context))
+
+# Los relojes viven en memoria: tras un reinicio cada mesa con mano en juego sigue donde
+# se quedó (reparto pendiente, calle cerrada, mano ya pagada o jugador en turno con
+# su reloj rearmado y botones nuevos)
+async def reanudar_mesa(room_id, context):
+    room = almacen.obtener_sala(room_id)
     if not room:
-        conn.close()
         return
+    players = room['players'].split(',') if room['players'] else []
+    if room['status'] == 'starting':
+        await iniciar_juego_automatico(room_id, context)
+    elif room['round'] == 'showdown':
+        await reiniciar_para_nueva_mano(room_id, context)
+    elif str(room['current_turn']) in players:
+        marcar_estado(room_id, room['current_turn'], room['state_version'])
+        await enviar_mesa_con_botones(room_id, context, room=room)
+    else:
+        await avanzar_ronda(room_id, context)
+
+# Los torneos también viven en memoria: tras un reinicio se devuelven las inscripciones
+# sin liquidar y se cierran sus mesas
+def devolver_torneos(context):
+    inscripciones = almacen.inscripciones_torneo()
+    mesas = [r for r, sala in almacen.obtener_salas(almacen.salas_en_juego()).items() if sala['tournament_id']]
+    if not inscripciones and not mesas:
+        return
+    with almacen.transaccion():
+        cambiar_fichas([(user_id, inscripcion) for _, user_id, inscripcion in inscripciones], 'reembolso torneo')
+        for torneo_id in {torneo_id for torneo_id, _, _ in inscripciones}:
+            almacen.liquidar_torneo(torneo_id)
+        almacen.actualizar_salas({r: MESA_CERRADA for r in mesas})
+    for torneo_id, user_id, inscripcion in inscripciones:
+        cola_salida.encolar_info(context.bot, user_id,
+                                 f"🚫 El torneo {torneo_id} se canceló por un reinicio del bot. "
+                                 f"Te devolvimos {inscripcion} fichas.")
+    logger.info(f"🏆 {len(inscripciones)} inscripciones de torneo devueltas y {len(mesas)} mesas cerradas")
+
+async def reanudar_mesas(context: ContextTypes.DEFAULT_TYPE):
+    devolver_torneos(context)
+    salas_en_juego = almacen.salas_en_juego()
+    for room_id in salas_en_juego:
+        context.application.create_task(reanudar_mesa(room_id, context))
+    if salas_en_juego:
+        logger.info(f"🔄 Reanudando {len(salas_en_juego)} mesas en juego")
+
+# Espectadores: una vista por versión de la mesa, compartida por todos los que miran
+SPECTATOR_RATE = int(os.getenv('SPECTATOR_RATE', '20'))
+
+class DifusorEspectadores:
+    def __init__(self, por_segundo):
+        self.por_segundo = por_segundo
+        # room_id -> set(chat_id)
+        self.salas = {}
+        # room_id -> (version, texto)
+        self._vistas = {}
+        # chat_id -> room_id con un estado pendiente; solo se guarda el último
+        self._pendientes = {}
+        self._orden = deque()
+        # chat_id -> instante del bucle antes del que Telegram no acepta más envíos
+        self._esperas = {}
+        self._despertar = None
+        self._tarea = None
+        self.bot = None
+
+    def agregar(self, room_id, chat_id):
+        # Un espectador mira una sola mesa a la vez
+        for mirando in self.salas.values():
+            mirando.discard(chat_id)
+        self.salas.setdefault(room_id, set()).add(chat_id)
+
+    def tiene_vista(self, room_id):
+        return room_id in self._vistas
+
+    def publicar(self, bot, room_id, version, texto):
+        self._vistas[room_id] = (version, texto)
+        self.marcar(bot, room_id, self.salas.get(room_id, ()))
+
+    # Deja pendiente la vista más reciente de la sala para estos espectadores
+    def marcar(self, bot, room_id, chat_ids):
+        self.bot = bot
+        for chat_id in chat_ids:
+            if chat_id not in self._pendientes:
+                self._orden.append(chat_id)
+            self._pendientes[chat_id] = room_id
+        self._lanzar()
+
+    def _lanzar(self):
+        if self._orden:
+            if self._tarea is None or self._tarea.done():
+                self._despertar = asyncio.Event()
+                self._tarea = asyncio.get_running_loop().create_task(self._despachar())
+            self._despertar.set()
+
+    # Pasada la espera, el espectador vuelve a la cola con la vista más reciente que tenga
+    def _reintentar(self, chat_id):
+        self._esperas.pop(chat_id, None)
+        if chat_id in self._pendientes:
+            self._orden.append(chat_id)
+            self._lanzar()
+
+    async def _enviar(self, chat_id, room_id, texto):
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=texto)
+        except RetryAfter as e:
+            # Telegram pide esperar: solo este espectador se aplaza, el lote sigue.
+            # Si entretanto llegó una vista más nueva se conserva esa.
+            loop = asyncio.get_running_loop()
+            self._esperas[chat_id] = loop.time() + e.retry_after
+            self._pendientes.setdefault(chat_id, room_id)
+            loop.call_later(e.retry_after, self._reintentar, chat_id)
+        except Exception as e:
+            logger.warning("Error enviando a espectador %s", chat_id,
+                           extra=registro.con_error(e, user_id=chat_id, room_id=room_id, action='espectador'))
+
+    # Envía por lotes de hasta `por_segundo` mensajes cada segundo
+    async def _despachar(self):
+        while self._orden:
+            inicio = asyncio.get_running_loop().time()
+            envios = []
+            while self._orden and len(envios) < self.por_segundo:
+                chat_id = self._orden.popleft()
+                if chat_id in self._esperas:
+                    # Sigue pendiente; lo vuelve a encolar _reintentar
+                    continue
+                room_id = self._pendientes.pop(chat_id, None)
+                vista = self._vistas.get(room_id)
+                if vista:
+                    envios.append(self._enviar(chat_id, room_id, vista[1]))
+            await asyncio.gather(*envios)
+            espera = 1 - (asyncio.get_running_loop().time() - inicio)
+            if self._orden and espera > 0:
+                await asyncio.sleep(espera)
+
+difusor = DifusorEspectadores(SPECTATOR_RATE)
+
+def publicar_espectadores(bot, room_id, mensaje_mesa):
+    room_id = int(room_id)
+    if difusor.salas.get(room_id):
+        difusor.publicar(bot, room_id, version_sala(room_id), f"👁️ **MODO ESPECTADOR** - Sala {room_id}\n{mensaje_mesa}")
+
+# Resultado final para los espectadores; dejan de mirar al terminar la mano
+def cerrar_espectadores(bot, room_id, resultado):
+    room_id = int(room_id)
+    if difusor.salas.get(room_id):
+        difusor.publicar(bot, room_id, version_sala(room_id),
+                         f"👁️ Sala {room_id}\n\n{resultado}\n\nUsa /mirar {room_id} para seguir mirando.")
+    difusor.salas.pop(room_id, None)
+
+# Tablas de equidad precalculadas (se abren con mmap en la primera consulta)
+tablas_equidad = equidad.TablasEquidad(os.getenv('EQUITY_TABLES', equidad.RUTA_TABLAS))
+NUMERO_CARTA = {f"{rank}{suit}": equidad.carta(r, p) for p, suit in enumerate(SUITS) for r, rank in enumerate(RANKS)}
+
+# Pista de fuerza para el jugador en turno: equidad antes del flop o en el flop
+# contra los que siguen en la mano ("" si no hay tabla para la calle)
+def pista_fuerza(room, players, asiento):
+    privadas = room['private_cards'].split(',') if room['private_cards'] else []
+    comunidad = room['community_cards'].split(',') if room['community_cards'] else []
+    if asiento*2+1 >= len(privadas):
+        return ""
+    mano = [NUMERO_CARTA[c] for c in privadas[asiento*2:asiento*2+2]]
+    rivales = motor.contar(((1 << len(players)) - 1) & ~(room['folded_mask'] or 0)) - 1
+    
+    if not comunidad:
+        fuerza = tablas_equidad.inicial(mano[0], mano[1], rivales)
+    elif len(comunidad) == 3:
+        fuerza = tablas_equidad.flop(mano, [NUMERO_CARTA[c] for c in comunidad], rivales)
+    else:
+        fuerza = None
+    if fuerza is None:
+        return ""
+    return f"\n📈 Fuerza estimada: {fuerza:.0%} contra {rivales} rival{'es' if rivales > 1 else ''}"
+
+# Enviar mesa con botones CORREGIDO
+async def enviar_mesa_con_botones(room_id, context, user_id_actual=None, room=None, inmediato=False):
+    if room is None:
+        room = almacen.obtener_sala(room_id)
+        perfil.marcar('lectura de la mesa')
+    
+    if not room:
+        return
+    
+    players = room['players'].split(',') if room['players'] else []
+    current_turn = str(room['current_turn'])
+    current_bet = room['current_bet']
     
-    players = room[0].split(',') if room[0] else []
-    current_turn = room[1]
-    current_bet = room[2]
+    # Reloj del jugador en turno
+    if room['status'] == 'playing' and current_turn in players:
+        armar_reloj_turno(room_id, current_turn)
     
-    mensaje_mesa = await mostrar_mesa(room_id, context)
+    mensaje_mesa = await mostrar_mesa(room_id, context, room)
+    perfil.marcar('render')
     
-    # Para cada jugador
+    # Nueva versión de la mesa: una sola vista para todos los espectadores
+    publicar_espectadores(context.bot, room_id, mensaje_mesa)
+    
+    # Para cada jugador; los botones de juego caducan con la siguiente versión de la mesa
+    version = version_sala(room_id)
     for player_id in players:
-        try:
-            # Determinar qué botones mostrar
-            if player_id == current_turn:
-                # JUGADOR EN TURNO - muestra todos los botones
-                keyboard = [
-                    [
-                        InlineKeyboardButton("📤 Subir 10", callback_data=f"raise_{room_id}_10"),
-                        InlineKeyboardButton("📤 Subir 50", callback_data=f"raise_{room_id}_50")
-                    ],
-                    [
-                        InlineKeyboardButton("✅ Igualar", callback_data=f"call_{room_id}"),
-                        InlineKeyboardButton("🔄 Pasar", callback_data=f"check_{room_id}")
-                    ],
-                    [
-                        InlineKeyboardButton("🏳️ Retirarse", callback_data=f"fold_{room_id}"),
-                        InlineKeyboardButton("👀 Ver Mesa", callback_data=f"view_{room_id}")
-                    ]
-                ]
-            else:
-                # JUGADOR ESPERANDO - solo botones básicos
-                keyboard = [
-                    [InlineKeyboardButton("👀 Ver Mesa", callback_data=f"view_{room_id}"),
-                     InlineKeyboardButton("💰 Mis Fichas", callback_data=f"chips_{room_id}")]
+        # Determinar qué botones mostrar
+        if player_id == current_turn:
+            # JUGADOR EN TURNO - muestra todos los botones
+            keyboard = [
+                [
+                    InlineKeyboardButton("📤 Subir 10", callback_data=f"raise_{room_id}_{version}_10"),
+                    InlineKeyboardButton("📤 Subir 50", callback_data=f"raise_{room_id}_{version}_50")
+                ],
+                [
+                    InlineKeyboardButton("✅ Igualar", callback_data=f"call_{room_id}_{version}"),
+                    InlineKeyboardButton("🔄 Pasar", callback_data=f"check_{room_id}_{version}")
+                ],
+                [
+                    InlineKeyboardButton("🏳️ Retirarse", callback_data=f"fold_{room_id}_{version}"),
+                    InlineKeyboardButton("👀 Ver Mesa", callback_data=f"view_{room_id}")
                 ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            # Si es el jugador actual que hizo la acción, editar su mensaje
-            if user_id_actual and str(user_id_actual) == player_id:
-                # Buscar el último mensaje para editarlo
-                try:
-                    await context.bot.send_message(
-                        chat_id=int(player_id),
-                        text=mensaje_mesa,
-                        reply_markup=reply_markup
-                    )
-                except:
-                    pass
-            else:
-                # Para otros jugadores, enviar nuevo mensaje
-                await context.bot.send_message(
-                    chat_id=int(player_id),
-                    text=mensaje_mesa,
-                    reply_markup=reply_markup
-                )
-        except Exception as e:
-            logger.error(f"Error enviando a {player_id}: {e}")
-    
-    conn.close()
+            ]
+        else:
+            # JUGADOR ESPERANDO - solo botones básicos
+            keyboard = [
+                [InlineKeyboardButton("👀 Ver Mesa", callback_data=f"view_{room_id}"),
+                 InlineKeyboardButton("💰 Mis Fichas", callback_data=f"chips_{room_id}")]
+            ]
+        
+        # El turno sale primero; el resto se fusiona con los avisos pendientes
+        cola_salida.encolar_mesa(
+            context.bot,
+            int(player_id),
+            mensaje_mesa + (pista_fuerza(room, players, players.index(player_id)) if player_id == current_turn else ""),
+            InlineKeyboardMarkup(keyboard),
+            en_turno=(player_id == current_turn),
+            room_id=room_id,
+            inmediato=inmediato
+        )
+    perfil.marcar('fan-out encolado')
 
 # Verificar si todos han actuado
 async def verificar_ronda_completa(room_id, context):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
+    cargado = cargar_mesa(room_id)
     
-    c.execute("SELECT players, player_actions, player_folded FROM game_rooms WHERE room_id=?", (room_id,))
-    room = c.fetchone()
-    
-    if not room:
-        conn.close()
+    if not cargado:
         return False
     
-    players = room[0].split(',') if room[0] else []
-    player_actions = room[1].split(',') if room[1] else []
-    player_folded = room[2].split(',') if room[2] else []
-    
-    # Filtrar jugadores activos (no retirados)
-    jugadores_activos = [p for p in players if p not in player_folded]
-    
-    # Si todos los activos han actuado
-    if len(player_actions) >= len(jugadores_activos):
-        conn.close()
+    # Si solo queda uno o todos los que pueden actuar ya actuaron
+    if motor.calle_terminada(cargado[1], 0):
+        perfil.marcar('ronda completa')
         await asyncio.sleep(2)  # Pequeña pausa
         await avanzar_ronda(room_id, context)
         return True
     
-    conn.close()
     return False
 
+MENSAJES_CALLE = {
+    'flop': "🃏 **¡FLOP REPARTIDO!** 🃏\nTres cartas comunitarias.\n\nNueva ronda de apuestas.",
+    'turn': "🃏 **¡TURN REPARTIDO!** 🃏\nCuarta carta comunitaria.\n\nNueva ronda de apuestas.",
+    'river': "🃏 **¡RIVER REPARTIDO!** 🃏\nQuinta carta comunitaria.\n\nÚltima ronda de apuestas."
+}
+
 # Avanzar a siguiente ronda
 async def avanzar_ronda(room_id, context):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
+    cargado = cargar_mesa(room_id)
+    if not cargado:
+        return
     
-    c.execute("SELECT round, players, player_folded, pot, community_cards, private_cards FROM game_rooms WHERE room_id=?", (room_id,))
-    room = c.fetchone()
+    players, m, room = cargado
+    community_str, private_str, deck_str = room['community_cards'], room['private_cards'], room['deck']
     
-    if not room:
-        conn.close()
+    # Mano ya pagada: nada que avanzar
+    if room['status'] != 'playing' or m.ronda[0] == motor.SHOWDOWN:
         return
     
-    ronda_actual = room[0]
-    players = room[1].split(',') if room[1] else []
-    folded = room[2].split(',') if room[2] else []
-    pot_actual = room[3]
-    community_str = room[4] or ""
-    private_str = room[5] or ""
-    
     # Si solo queda 1 jugador activo, gana
-    jugadores_activos = [p for p in players if p not in folded]
-    
-    if len(jugadores_activos) == 1:
-        await finalizar_mano_por_retirada(room_id, jugadores_activos[0], pot_actual, context)
-        conn.close()
+    if motor.ultimo_en_pie(m, 0) >= 0:
+        await finalizar_mano_por_retirada(room_id, players, m, room['state_version'], context)
         return
     
     # Determinar siguiente ronda
-    nueva_ronda = ronda_actual
-    cartas_comunidad = community_str.split(',') if community_str else []
-    cartas_usadas = (private_str.split(',') if private_str else []) + cartas_comunidad
-    
-    mensaje_ronda = ""
-    
-    if ronda_actual == 'preflop':
-        nueva_ronda = 'flop'
-        # Repartir FLOP (3 cartas)
-        mazo = [carta for carta in DECK if carta not in cartas_usadas]
-        random.shuffle(mazo)
-        flop = mazo[:3]
-        cartas_comunidad = flop
-        
-        mensaje_ronda = "🃏 **¡FLOP REPARTIDO!** 🃏\nTres cartas comunitarias.\n\nNueva ronda de apuestas."
-        
-    elif ronda_actual == 'flop':
-        nueva_ronda = 'turn'
-        # Repartir TURN (1 carta)
-        mazo = [carta for carta in DECK if carta not in cartas_usadas]
-        random.shuffle(mazo)
-        if mazo:
-            cartas_comunidad.append(mazo[0])
-        
-        mensaje_ronda = "🃏 **¡TURN REPARTIDO!** 🃏\nCuarta carta comunitaria.\n\nNueva ronda de apuestas."
-        
-    elif ronda_actual == 'turn':
-        nueva_ronda = 'river'
-        # Repartir RIVER (1 carta)
-        mazo = [carta for carta in DECK if carta not in cartas_usadas]
-        random.shuffle(mazo)
-        if mazo:
-            cartas_comunidad.append(mazo[0])
-        
-        mensaje_ronda = "🃏 **¡RIVER REPARTIDO!** 🃏\nQuinta carta comunitaria.\n\nÚltima ronda de apuestas."
-        
-    elif ronda_actual == 'river':
+    nueva_ronda = motor.siguiente_calle(m, 0)
+    if nueva_ronda == 'showdown':
         await showdown(room_id, context)
-        conn.close()
         return
     
-    # Actualizar base de datos
-    c.execute("UPDATE game_rooms SET round=?, community_cards=?, current_bet=0, player_actions='', current_turn=? WHERE room_id=?", 
-             (nueva_ronda, ','.join(cartas_comunidad), players[0], room_id))
+    # Repartir las cartas de la calle desde el mazo de la mano
+    cartas_comunidad = community_str.split(',') if community_str else []
+    cartas_usadas = (private_str.split(',') if private_str else []) + cartas_comunidad
+    cartas_comunidad.extend(cartas_del_mazo(deck_str, cartas_usadas, motor.CARTAS_POR_CALLE[nueva_ronda]))
+    mensaje_ronda = MENSAJES_CALLE[nueva_ronda]
     
-    conn.commit()
-    conn.close()
+    # Actualizar base de datos (si otro worker ya avanzó la calle, es suya)
+    try:
+        guardar_mesa(room_id, players, m, room['state_version'], community_cards=','.join(cartas_comunidad))
+    except SalaCambiada:
+        return
+    perfil.marcar(f'avance a {nueva_ronda}')
     
-    # Enviar mensaje de nueva ronda
+    # Aviso de nueva ronda: se fusiona con la mesa que se encola a continuación
     for player_id in players:
-        try:
-            await context.bot.send_message(
-                chat_id=int(player_id),
-                text=mensaje_ronda
-            )
-        except:
-            pass
+        cola_salida.encolar_info(context.bot, int(player_id), mensaje_ronda, room_id=room_id)
     
     # Mostrar mesa actualizada CON BOTONES
     await enviar_mesa_con_botones(room_id, context)
+    
+    # Si nadie puede apostar (todos all-in) se reparten las calles restantes
+    if motor.calle_terminada(m, 0):
+        await verificar_ronda_completa(room_id, context)
 
 # Finalizar mano por retirada
-async def finalizar_mano_por_retirada(room_id, ganador_id, pot, context):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT username FROM users WHERE user_id=?", (int(ganador_id),))
-    ganador_nombre = c.fetchone()[0]
-    
-    # Dar premio al ganador
-    c.execute("UPDATE users SET chips = chips + ? WHERE user_id=?", (pot, ganador_id))
+async def finalizar_mano_por_retirada(room_id, players, m, version, context):
+    cancelar_reloj_turno(room_id)
+    
+    ganador_id = players[motor.ultimo_en_pie(m, 0)]
+    pot = m.bote[0]
+    ganador = obtener_usuario(ganador_id)
+    ganador_nombre = ganador[0] if ganador else "Jugador"
+    
+    # Dar premio al ganador y cerrar la mano (round='showdown', bote 0, nadie en turno)
+    # en la misma transacción: un toque tardío ya no encuentra mano que cobrar y si otro
+    # worker cerró la mano antes, no se paga dos veces
+    motor.repartir_bote(m, 0, [])
+    try:
+        with almacen.transaccion():
+            guardar_mesa(room_id, players, m, version)
+            pagar_en_mesa(room_id, [(ganador_id, pot)], 'premio')
+            almacen.archivar_mano(room_id, [ganador_id], pot)
+    except SalaCambiada:
+        return
     
-    c.execute("SELECT players, player_names FROM game_rooms WHERE room_id=?", (room_id,))
-    room = c.fetchone()
-    players = room[0].split(',') if room[0] else []
-    player_names = room[1].split(',') if room[1] else []
+    # Sin showdown no se revela el mazo: mostraría las cartas del ganador y de los retirados
+    room = almacen.obtener_sala(room_id)
+    player_names = room['player_names'].split(',') if room['player_names'] else []
     
     # Notificar a todos
     for i, player_id in enumerate(players):
@@ -372,39 +1051,62 @@ async def finalizar_mano_por_retirada(room_id, ganador_id, pot, context):
                 chat_id=int(player_id),
                 text=msg
             )
-        except:
-            pass
+        except Exception as e:
+            logger.warning("Error enviando a %s", player_id,
+                           extra=registro.con_error(e, user_id=int(player_id), room_id=int(room_id), action='retirada'))
     
-    conn.close()
+    cerrar_espectadores(context.bot, room_id, f"🏆 {ganador_nombre} gana {pot} fichas por retirada.")
     
     # Esperar y reiniciar
     await asyncio.sleep(5)
     await reiniciar_para_nueva_mano(room_id, context)
     # Showdown - determinar ganador
 async def showdown(room_id, context):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
+    cancelar_reloj_turno(room_id)
     
-    c.execute("SELECT players, player_names, private_cards, community_cards, pot FROM game_rooms WHERE room_id=?", (room_id,))
-    data = c.fetchone()
+    cargado = cargar_mesa(room_id)
+    if not cargado:
+        return
+    players, m, room = cargado
+    if room['status'] != 'playing' or m.ronda[0] == motor.SHOWDOWN:
+        return
     
-    players = data[0].split(',') if data[0] else []
-    player_names = data[1].split(',') if data[1] else []
-    private_str = data[2] or ""
-    community_str = data[3] or ""
-    pot = data[4]
+    player_names = room['player_names'].split(',') if room['player_names'] else []
+    private_str = room['private_cards'] or ""
+    community_str = room['community_cards'] or ""
+    pot = m.bote[0]
+    revelacion = revelar_mazo(room['deck'], room['deck_salt'], room['deck_commit'])
     
     # Cartas
     todas_cartas = private_str.split(',') if private_str else []
     cartas_com = community_str.split(',') if community_str else []
     
-    # Determinar ganador (simplificado - por ahora aleatorio)
-    ganador_idx = random.randint(0, len(players)-1)
-    ganador_id = players[ganador_idx]
-    ganador_nombre = player_names[ganador_idx] if ganador_idx < len(player_names) else "Jugador"
-    
-    # Dar premio
-    c.execute("UPDATE users SET chips = chips + ? WHERE user_id=?", (pot, ganador_id))
+    # Determinar ganador: mejor mano de 5 entre las privadas y la mesa (el motor ignora a los retirados)
+    mesa = [NUMERO_CARTA[c] for c in cartas_com]
+    fuerzas = [0] * motor.MAX_ASIENTOS
+    for asiento in range(len(players)):
+        if asiento*2+1 < len(todas_cartas):
+            fuerzas[asiento] = equidad.valor_mano([NUMERO_CARTA[c] for c in todas_cartas[asiento*2:asiento*2+2]] + mesa)
+    premios, devoluciones = motor.repartir_bote(m, 0, fuerzas)
+    # Lo que nadie igualó vuelve a quien lo apostó y no cuenta como bote ganado
+    pot -= sum(devoluciones)
+    
+    # Todos los que ganan un bote (dividido o lateral), de mayor a menor premio
+    ganadores = sorted((a for a in range(len(players)) if premios[a] > 0), key=lambda a: -premios[a])
+    nombres = [player_names[a] if a < len(player_names) else "Jugador" for a in range(len(players))]
+    jugadas = [equidad.CATEGORIAS[equidad.categoria(fuerzas[a])] for a in range(len(players))]
+    nombres_ganadores = " y ".join(nombres[a] for a in ganadores)
+    reparto = "".join(f"• {nombres[a]}: {premios[a]} fichas con {jugadas[a]}\n" for a in ganadores)
+    
+    # Dar premios (botes laterales incluidos) y cerrar la mano en la misma transacción
+    try:
+        with almacen.transaccion():
+            guardar_mesa(room_id, players, m, room['state_version'])
+            pagar_en_mesa(room_id, zip(players, premios), 'premio')
+            pagar_en_mesa(room_id, zip(players, devoluciones), 'devolucion')
+            almacen.archivar_mano(room_id, [players[a] for a in ganadores], pot)
+    except SalaCambiada:
+        return
     
     # Mostrar resultados a cada jugador
     for i, player_id in enumerate(players):
@@ -420,28 +1122,36 @@ async def showdown(room_id, context):
                 cartas_jugador = "??  ??"
             
             cartas_com_display = "  ".join(cartas_com)
+            devuelto = f"↩️ Se te devuelven {devoluciones[i]} fichas que nadie igualó.\n\n" if devoluciones[i] else ""
             
-            if player_id == ganador_id:
+            if premios[i] > 0:
                 msg = f"🏆 **¡FELICIDADES {nombre}!** 🏆\n\n" \
                       f"Tus cartas: {cartas_jugador}\n" \
                       f"Mesa: {cartas_com_display}\n\n" \
-                      f"Has ganado {pot} fichas!\n\n" \
+                      f"Has ganado {premios[i]} fichas con {jugadas[i]}!\n\n" \
+                      + (f"Bote de {pot} repartido:\n{reparto}\n" if len(ganadores) > 1 else "") \
+                      + devuelto + \
+                      f"{revelacion}" \
                       f"🎰 **Nueva mano en 5 segundos...**"
             else:
-                msg = f"😞 **{ganador_nombre} gana la mano.**\n\n" \
+                msg = f"😞 **{nombres_ganadores} {'ganan' if len(ganadores) > 1 else 'gana'} la mano.**\n\n" \
                       f"Tus cartas: {cartas_jugador}\n" \
                       f"Mesa: {cartas_com_display}\n\n" \
-                      f"Premio: {pot} fichas\n\n" \
+                      f"Bote de {pot} fichas:\n{reparto}\n" \
+                      + devuelto + \
+                      f"{revelacion}" \
                       f"🎰 **Nueva mano en 5 segundos...**"
             
             await context.bot.send_message(
                 chat_id=int(player_id),
                 text=msg
             )
-        except:
-            pass
+        except Exception as e:
+            logger.warning("Error enviando a %s", player_id,
+                           extra=registro.con_error(e, user_id=int(player_id), room_id=int(room_id), action='showdown'))
     
-    conn.close()
+    cerrar_espectadores(context.bot, room_id,
+                        f"🏆 Showdown, bote de {pot} fichas:\n{reparto}Mesa: {'  '.join(cartas_com)}")
     
     # Esperar y reiniciar
     await asyncio.sleep(5)
@@ -449,32 +1159,30 @@ async def showdown(room_id, context):
 
 # Reiniciar para nueva mano automáticamente
 async def reiniciar_para_nueva_mano(room_id, context):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
+    t = torneo_de_mesa.get(int(room_id))
+    if t:
+        await fin_mano_torneo(t, int(room_id), context)
+        return
     
-    c.execute("SELECT players, player_names FROM game_rooms WHERE room_id=?", (room_id,))
-    data = c.fetchone()
+    data = almacen.obtener_sala(room_id)
     
     if not data:
-        conn.close()
         return
     
-    players = data[0].split(',') if data[0] else []
-    player_names = data[1].split(',') if data[1] else []
+    players = data['players'].split(',') if data['players'] else []
+    player_names = data['player_names'].split(',') if data['player_names'] else []
     
     # Verificar si alguien se quedó sin fichas
-    c.execute("SELECT chips FROM users WHERE user_id IN (" + ",".join(["?"]*len(players)) + ")", players)
-    chips_list = c.fetchall()
+    usuarios = precargar_usuarios(players)
     
-    alguien_sin_fichas = any(chips[0] <= 0 for chips in chips_list if chips)
+    alguien_sin_fichas = any(user[1] <= 0 for user in usuarios.values() if user)
     
     if alguien_sin_fichas:
         # Juego terminado
         for i, player_id in enumerate(players):
             try:
                 nombre = player_names[i] if i < len(player_names) else "Jugador"
-                c.execute("SELECT chips FROM users WHERE user_id=?", (player_id,))
-                fichas = c.fetchone()[0]
+                fichas = usuarios[int(player_id)][1]
                 
                 await context.bot.send_message(
                     chat_id=int(player_id),
@@ -482,127 +1190,186 @@ async def reiniciar_para_nueva_mano(room_id, context):
                          f"{nombre}, te quedaste con {fichas} fichas.\n\n"
                          f"Crea nueva sala con /crear_sala"
                 )
-            except:
-                pass
+            except Exception as e:
+                logger.warning("Error enviando a %s", player_id,
+                               extra=registro.con_error(e, user_id=int(player_id), room_id=int(room_id), action='fin de partida'))
         
-        # Resetear sala
-        c.execute("UPDATE game_rooms SET status='waiting', current_players=1, players='', player_names='', private_cards='', community_cards='', pot=0, current_bet=0, current_turn=0, round='preflop', player_actions='', player_folded='' WHERE room_id=?", (room_id,))
+        # Resetear sala (la escritura sube su versión: los botones que queden ya no valen)
+        olvidar_estado(room_id)
+        almacen.actualizar_sala(room_id, dict(
+            status='waiting', current_players=1, players='', player_names='', private_cards='', community_cards='',
+            pot=0, current_bet=0, current_turn=0, round='preflop', player_actions='', player_folded='',
+            dealer_seat=0, turn_seat=0, folded_mask=0, allin_mask=0, acted_mask=0, seat_bets='', seat_contrib=''))
     else:
-        # Reiniciar para nueva mano
-        c.execute("UPDATE game_rooms SET pot=0, current_bet=0, round='preflop', community_cards='', player_folded='', player_actions='', current_turn=? WHERE room_id=?", (players[0], room_id))
-        
-        # Iniciar nueva mano automáticamente
-        await iniciar_juego_automatico(room_id, context)
+        await siguiente_mano(room_id, players, data['dealer_seat'], context)
+
+# Nueva mano con el botón una posición a la izquierda (el reinicio de la sala va
+# en la misma escritura que el reparto)
+async def siguiente_mano(room_id, players, dealer_seat, context):
+    boton = motor.siguiente_en((1 << len(players)) - 1, dealer_seat or 0)
+    await iniciar_juego_automatico(room_id, context, boton)
+
+# Asientos de una mesa de torneo tal como se guardan en la sala
+def campos_asientos(t, asientos):
+    return {'players': ','.join(str(u) for u in asientos),
+            'player_names': ','.join(t.nombres[u] for u in asientos),
+            'current_players': len(asientos)}
+
+MESA_CERRADA = {'status': 'closed', 'players': '', 'player_names': '', 'current_players': 0}
+
+# Fin de mano en una mesa de torneo: eliminaciones, cambios de mesa por lotes y siguientes manos
+async def fin_mano_torneo(t, room_id, context):
+    eliminados, cambios, cerradas = t.fin_mano(room_id)
+    for user_id in eliminados:
+        cola_salida.encolar_info(context.bot, user_id,
+                                 f"💀 Quedaste eliminado del torneo {t.id} en la posición {t.posicion(user_id)} de {len(t.nombres)}.")
+    
+    if t.terminado():
+        await terminar_torneo(t, cerradas, context)
+        return
     
-    conn.commit()
-    conn.close()
+    # Todos los movimientos de asientos en una sola escritura
+    salas = almacen.obtener_salas([room_id] + list(cambios))
+    with almacen.transaccion():
+        actualizaciones = {r: campos_asientos(t, asientos) for r, asientos in cambios.items()}
+        actualizaciones.update({r: MESA_CERRADA for r in cerradas})
+        almacen.actualizar_salas(actualizaciones)
+    for r in cerradas:
+        torneo_de_mesa.pop(r, None)
+        cancelar_reloj_turno(r)
+        olvidar_estado(r)
+    
+    for r, asientos in cambios.items():
+        antes = set(salas[r]['players'].split(',')) if r in salas and salas[r]['players'] else set()
+        for user_id in asientos:
+            if str(user_id) not in antes:
+                cola_salida.encolar_info(context.bot, user_id, f"🔀 Torneo {t.id}: pasas a la mesa {r}.")
+    
+    # Mesas libres con al menos dos jugadores: la que acaba de terminar y las que recibieron gente
+    for r in dict.fromkeys([room_id] + list(cambios)):
+        asientos = t.asientos.get(r, ())
+        if r in t.en_mano or len(asientos) < 2:
+            continue
+        t.empezar_mano(r)
+        mano = siguiente_mano(r, [str(u) for u in asientos], salas[r]['dealer_seat'] if r in salas else 0, context)
+        if r == room_id:
+            await mano
+        else:
+            context.application.create_task(mano)
+
+async def terminar_torneo(t, cerradas, context):
+    campeon = t.campeon()
+    pozo = TOURNEY_BUYIN * len(t.nombres)
+    with almacen.transaccion():
+        if campeon is not None:
+            cambiar_fichas([(campeon, pozo)], 'torneo')
+        almacen.liquidar_torneo(t.id)
+        almacen.actualizar_salas({r: MESA_CERRADA for r in cerradas})
+    for r in cerradas:
+        torneo_de_mesa.pop(r, None)
+        cancelar_reloj_turno(r)
+        olvidar_estado(r)
+    for job in context.job_queue.get_jobs_by_name(f"torneo_{t.id}"):
+        job.schedule_removal()
+    
+    if campeon is not None:
+        cola_salida.encolar_info(context.bot, campeon,
+                                 f"🏆 ¡Ganaste el torneo {t.id} entre {len(t.nombres)} jugadores!\nPremio: {pozo} fichas")
+
+# Sube el nivel de ciegas de un torneo (se aplica desde la próxima mano de cada mesa)
+async def subir_nivel_torneo(context: ContextTypes.DEFAULT_TYPE):
+    t = torneos.get(context.job.data)
+    if t is None or t.terminado():
+        context.job.schedule_removal()
+        return
+    if t.subir_nivel():
+        small_blind, big_blind = t.ciegas()
+        for user_id in t.vivos:
+            cola_salida.encolar_info(context.bot, user_id,
+                                     f"⬆️ Torneo {t.id}: nivel {t.nivel + 1}, ciegas {small_blind}/{big_blind} desde la próxima mano.")
+
+# Ciegas de las mesas normales (en torneo las marca el nivel)
+SMALL_BLIND = 10
+BIG_BLIND = 20
 
 # Iniciar juego automático
-async def iniciar_juego_automatico(room_id, context):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT players, player_names FROM game_rooms WHERE room_id=?", (room_id,))
-    room = c.fetchone()
+async def iniciar_juego_automatico(room_id, context, boton=None):
+    room = almacen.obtener_sala(room_id)
     
     if not room:
-        conn.close()
         return
     
-    players = room[0].split(',') if room[0] else []
-    player_names = room[1].split(',') if room[1] else []
+    players = room['players'].split(',') if room['players'] else []
+    player_names = room['player_names'].split(',') if room['player_names'] else []
     
     if len(players) >= 2:
-        # Mezclar mazo
-        mazo = DECK.copy()
-        random.shuffle(mazo)
-        
-        # Repartir 2 cartas a cada jugador
-        cartas_repartidas = []
-        for i in range(len(players)):
-            if i*2+1 < len(mazo):
-                cartas_repartidas.extend([mazo[i*2], mazo[i*2+1]])
+        # Permutación completa de la mano y su compromiso público; 2 cartas por jugador
+        mazo, sal, compromiso = barajador.nueva_mano()
+        cartas_repartidas = mazo[:len(players) * 2]
         
-        # Enviar cartas privadas a cada jugador
-        for i, player_id in enumerate(players):
-            if i*2+1 < len(cartas_repartidas):
-                carta1 = cartas_repartidas[i*2]
-                carta2 = cartas_repartidas[i*2+1]
-                
-                try:
-                    nombre = player_names[i] if i < len(player_names) else "Jugador"
-                    await context.bot.send_message(
-                        chat_id=int(player_id),
-                        text=f"🎴 **TUS CARTAS PRIVADAS** 🎴\n\n"
-                             f"🃏 {carta1}  🃏 {carta2}\n\n"
-                             f"¡Buena suerte {nombre}!\n"
-                             f"Mantén estas cartas en secreto."
-                    )
-                except:
-                    pass
+        # Ciegas del nivel del torneo o las de mesa normal
+        t = torneo_de_mesa.get(int(room_id))
+        small_blind, big_blind = t.ciegas() if t else (SMALL_BLIND, BIG_BLIND)
         
-        # Configurar ciegas
-        small_blind = 10
-        big_blind = 20
+        # Ciegas según la posición del botón
+        m = motor.Mesas(1)
+        motor.nueva_mano(m, 0, fichas_en_mesa(room_id, players), room['dealer_seat'] or 0 if boton is None else boton,
+                         small_blind, big_blind)
+        perfil.marcar('reparto')
         
-        # Quitar fichas por ciegas
-        if len(players) >= 2:
-            c.execute("UPDATE users SET chips = chips - ? WHERE user_id=?", (small_blind, players[0]))
-            c.execute("UPDATE users SET chips = chips - ? WHERE user_id=?", (big_blind, players[1]))
-        
-        pot = small_blind + big_blind
-        current_bet = big_blind
+        # Ciegas, reparto y estado inicial en una sola transacción (si otro worker ya
+        # repartió esta mano, no se cobran las ciegas otra vez)
+        try:
+            with almacen.transaccion():
+                room.update(guardar_mesa(room_id, players, m, room['state_version'], status='playing',
+                                         private_cards=','.join(cartas_repartidas), community_cards='',
+                                         player_folded='', player_actions='',
+                                         deck=','.join(mazo), deck_salt=sal, deck_commit=compromiso))
+                pagar_en_mesa(room_id, [(p, -m.apuestas[asiento]) for asiento, p in enumerate(players)], 'ciega')
+        except SalaCambiada:
+            return
+        perfil.marcar('estado guardado')
         
-        # Guardar estado inicial
-        c.execute("UPDATE game_rooms SET status='playing', private_cards=?, pot=?, current_bet=?, current_turn=?, round='preflop' WHERE room_id=?", 
-                 (','.join(cartas_repartidas), pot, current_bet, players[1], room_id))
+        # Cartas privadas: viajan en el mismo mensaje que la primera vista de la mesa
+        for i, player_id in enumerate(players):
+            nombre = player_names[i] if i < len(player_names) else "Jugador"
+            cola_salida.encolar_info(
+                context.bot,
+                int(player_id),
+                f"🎴 **TUS CARTAS PRIVADAS** 🎴\n\n"
+                f"🃏 {cartas_repartidas[i*2]}  🃏 {cartas_repartidas[i*2+1]}\n\n"
+                f"¡Buena suerte {nombre}!\n"
+                f"Mantén estas cartas en secreto.\n\n"
+                f"🔐 Compromiso del mazo:\n{compromiso}",
+                room_id=room_id
+            )
         
-        conn.commit()
+        # Mesa inicial CON BOTONES desde la sala en memoria, a todos los asientos a la vez
+        await enviar_mesa_con_botones(room_id, context, room=room, inmediato=True)
         
-        # Mostrar mesa inicial CON BOTONES
-        await enviar_mesa_con_botones(room_id, context)
-    
-    conn.close()
+        # Ciegas que dejan a todos all-in (o al único que queda sin nada que igualar):
+        # nadie tiene turno y se reparten las calles sin esperar a un botón
+        if motor.calle_terminada(m, 0):
+            await verificar_ronda_completa(room_id, context)
 
 # Comando /unirse
 async def unirse(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    user = c.fetchone()
+    user = obtener_usuario(user_id)
     
     if not user:
         await update.message.reply_text("❌ Debes registrarte primero con /registro_test [nombre]")
-        conn.close()
         return
     
-    username = user[1]
+    username = user[0]
     
-    # Buscar sala
-    c.execute("SELECT * FROM game_rooms WHERE status='waiting' AND current_players < max_players LIMIT 1")
-    room = c.fetchone()
+    # Buscar sala y sentarse
+    room = almacen.sentar(user_id, username)
     
     if room:
-        room_id = room[0]
-        current_players = room[3] + 1
-        
-        # Actualizar jugadores
-        c.execute("SELECT players, player_names FROM game_rooms WHERE room_id=?", (room_id,))
-        data = c.fetchone()
-        players_str = data[0] or ""
-        names_str = data[1] or ""
-        
-        players = players_str.split(',') if players_str else []
-        names = names_str.split(',') if names_str else []
-        
-        players.append(str(user_id))
-        names.append(username)
-        
-        c.execute("UPDATE game_rooms SET current_players=?, players=?, player_names=? WHERE room_id=?",
-                 (current_players, ','.join(players), ','.join(names), room_id))
+        room_id = room['room_id']
+        current_players = room['current_players']
         
         await update.message.reply_text(
             f"✅ ¡{username} se unió a la sala {room_id}!\n"
@@ -612,60 +1379,37 @@ async def unirse(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Iniciar juego si hay 2
         if current_players >= 2:
-            c.execute("UPDATE game_rooms SET status='starting' WHERE room_id=?", (room_id,))
-            conn.commit()
-            conn.close()
+            almacen.actualizar_sala(room_id, {'status': 'starting'})
             
             await update.message.reply_text("🎰 ¡2 JUGADORES! Iniciando partida...")
-            await asyncio.sleep(2)
             await iniciar_juego_automatico(room_id, context)
-        else:
-            conn.commit()
-            conn.close()
     else:
         await update.message.reply_text("📝 No hay salas. Crea una con /crear_sala")
-        conn.close()
 
 # Comando /crear_sala
 async def crear_sala(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    user = c.fetchone()
+    user = obtener_usuario(user_id)
     
     if not user:
         await update.message.reply_text("❌ Debes registrarte primero con /registro_test [nombre]")
-        conn.close()
         return
     
-    username = user[1]
+    username = user[0]
     
     # Crear sala
-    c.execute("INSERT INTO game_rooms (creator_id, players, player_names) VALUES (?, ?, ?)", 
-             (user_id, str(user_id), username))
-    conn.commit()
-    
-    c.execute("SELECT last_insert_rowid()")
-    room_id = c.fetchone()[0]
+    room_id = almacen.crear_sala({'creator_id': user_id, 'players': str(user_id), 'player_names': username})
     
     await update.message.reply_text(
         f"✅ ¡Sala {room_id} creada!\n"
         f"Esperando otro jugador...\n\n"
         f"⚠️ Cuando otro se una con /unirse, el poker comienza AUTOMÁTICAMENTE!"
     )
-    
-    conn.close()
 
 # Comando /salas
 async def salas(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT room_id, current_players, max_players FROM game_rooms WHERE status='waiting'")
-    rooms = c.fetchall()
+    rooms = almacen.salas_en_espera()
     
     if not rooms:
         await update.message.reply_text("📭 No hay salas disponibles. ¡Crea una con /crear_sala!")
@@ -676,34 +1420,352 @@ async def salas(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         mensaje += "\n⚠️ Únete con /unirse - ¡El juego es AUTOMÁTICO!"
         await update.message.reply_text(mensaje)
-    
-    conn.close()
 
 # Comando /chips
 async def chips(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    conn = sqlite3.connect('poker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT username, chips FROM users WHERE user_id=?", (user_id,))
-    user = c.fetchone()
+    user = obtener_usuario(user_id)
     
     if user:
         await update.message.reply_text(f"💰 {user[0]}, tienes {user[1]} fichas")
     else:
         await update.message.reply_text("❌ No estás registrado. Usa /registro_test [nombre]")
+
+# Comando /mirar
+async def mirar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    if not args or not args[0].isdigit():
+        await update.message.reply_text("Uso: /mirar [número_de_sala]")
+        return
+    
+    room_id = int(args[0])
     
-    conn.close()
+    room = almacen.obtener_sala(room_id)
+    
+    if not room:
+        await update.message.reply_text("❌ Esa sala no existe. Mira las salas con /salas")
+        return
+    
+    difusor.agregar(room_id, update.effective_chat.id)
+    await update.message.reply_text(
+        f"👁️ Mirando la sala {room_id}.\n"
+        f"Verás la mesa en vivo (sin cartas privadas) hasta el showdown."
+    )
+    
+    # Estado actual solo para el nuevo espectador
+    if room['status'] == 'playing':
+        if difusor.tiene_vista(room_id):
+            difusor.marcar(context.bot, room_id, [update.effective_chat.id])
+        else:
+            publicar_espectadores(context.bot, room_id, await mostrar_mesa(room_id, context))
+
+# Comando /ranking
+async def ranking_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    if ranking.total() == 0:
+        await update.message.reply_text("📭 Todavía no hay jugadores registrados.")
+        return
+    
+    mensaje = f"🏆 **Ranking de Fichas** 🏆\n\n{ranking.render_top()}\n\n"
+    posicion = ranking.posicion(user_id)
+    if posicion:
+        user = obtener_usuario(user_id)
+        mensaje += f"📍 Tu posición: {posicion}/{ranking.total()} con {user[1]} fichas"
+    else:
+        mensaje += "❌ No estás registrado. Usa /registro_test [nombre]"
+    
+    await update.message.reply_text(mensaje)
+
+# Comando /torneo
+async def torneo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    user_id = update.effective_user.id
+    accion = args[0] if args else ''
+    t = torneos.get(int(args[1])) if len(args) > 1 and args[1].isdigit() else None
+    
+    if accion == 'crear':
+        user = obtener_usuario(user_id)
+        if not user:
+            await update.message.reply_text("❌ Debes registrarte primero con /registro_test [nombre]")
+            return
+        t = torneo.Torneo(max(torneos, default=0) + 1, user_id, TOURNEY_TABLE_SIZE, TOURNEY_STACK)
+        torneos[t.id] = t
+        await update.message.reply_text(
+            f"🏆 Torneo {t.id} creado.\n"
+            f"Inscripción: {TOURNEY_BUYIN} fichas, mesas de {t.tamano_mesa}, {t.fichas_iniciales} fichas de torneo.\n\n"
+            f"Inscríbete con /torneo unirse {t.id}\n"
+            f"Empieza con /torneo empezar {t.id}"
+        )
+    
+    elif accion == 'unirse' and t:
+        user = obtener_usuario(user_id)
+        if not user:
+            await update.message.reply_text("❌ Debes registrarte primero con /registro_test [nombre]")
+            return
+        if user[1] < TOURNEY_BUYIN:
+            await update.message.reply_text(f"❌ Necesitas {TOURNEY_BUYIN} fichas para inscribirte")
+            return
+        try:
+            t.inscribir(user_id, user[0])
+        except torneo.ErrorTorneo as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        with almacen.transaccion():
+            cambiar_fichas([(user_id, -TOURNEY_BUYIN)], 'torneo')
+            almacen.inscribir_torneo(t.id, user_id, TOURNEY_BUYIN)
+        await update.message.reply_text(f"✅ Inscrito en el torneo {t.id} ({len(t.nombres)} jugadores)")
+    
+    elif accion == 'empezar' and t:
+        if t.creador_id != user_id:
+            await update.message.reply_text("❌ Solo quien creó el torneo puede empezarlo")
+            return
+        if t.estado != 'registro' or len(t.nombres) < 2:
+            await update.message.reply_text("❌ Hacen falta al menos 2 inscritos y que no haya empezado")
+            return
+        
+        # Todas las mesas se crean y se sientan de una vez
+        n_mesas = math.ceil(len(t.nombres) / t.tamano_mesa)
+        with almacen.transaccion():
+            room_ids = [almacen.crear_sala({'creator_id': user_id, 'status': 'playing', 'max_players': t.tamano_mesa,
+                                            'tournament_id': t.id})
+                        for _ in range(n_mesas)]
+            t.repartir(room_ids)
+            almacen.actualizar_salas({r: campos_asientos(t, t.asientos[r]) for r in room_ids})
+        for r in room_ids:
+            torneo_de_mesa[r] = t
+        
+        context.job_queue.run_repeating(subir_nivel_torneo, interval=TOURNEY_LEVEL_SECS, first=TOURNEY_LEVEL_SECS,
+                                        data=t.id, name=f"torneo_{t.id}")
+        
+        small_blind, big_blind = t.ciegas()
+        await update.message.reply_text(f"🎰 ¡Torneo {t.id} en marcha! {len(t.nombres)} jugadores en {n_mesas} mesas.")
+        for r in room_ids:
+            for jugador in t.asientos[r]:
+                cola_salida.encolar_info(context.bot, jugador,
+                                         f"🏆 Torneo {t.id}: tu mesa es la {r}. Ciegas {small_blind}/{big_blind}, "
+                                         f"suben cada {TOURNEY_LEVEL_SECS // 60} minutos.")
+        
+        # Todas las mesas con al menos dos jugadores empiezan a la vez; una mesa en mano
+        # sin reparto no volvería a quedar libre para recibir a nadie
+        for r in room_ids:
+            if len(t.asientos[r]) < 2:
+                continue
+            t.empezar_mano(r)
+            context.application.create_task(iniciar_juego_automatico(r, context))
+    
+    elif accion == 'cancelar' and t:
+        if t.creador_id != user_id:
+            await update.message.reply_text("❌ Solo quien creó el torneo puede cancelarlo")
+            return
+        if t.estado != 'registro':
+            await update.message.reply_text("❌ El torneo ya empezó")
+            return
+        
+        # Devuelve la inscripción a cada inscrito
+        with almacen.transaccion():
+            cambiar_fichas([(u, TOURNEY_BUYIN) for u in t.nombres], 'reembolso torneo')
+            almacen.liquidar_torneo(t.id)
+        torneos.pop(t.id, None)
+        await update.message.reply_text(f"🚫 Torneo {t.id} cancelado.")
+        for jugador in t.nombres:
+            cola_salida.encolar_info(context.bot, jugador,
+                                     f"🚫 El torneo {t.id} se canceló. Te devolvimos {TOURNEY_BUYIN} fichas.")
+    
+    elif accion == 'ver' and t:
+        small_blind, big_blind = t.ciegas()
+        mensaje = (f"🏆 **Torneo {t.id}**\n\n"
+                   f"Estado: {t.estado}\n"
+                   f"Inscritos: {len(t.nombres)}\n")
+        if t.estado != 'registro':
+            mensaje += (f"Quedan: {len(t.vivos)} en {len(t.asignados)} mesas\n"
+                        f"Nivel {t.nivel + 1}: ciegas {small_blind}/{big_blind}\n")
+        if user_id in t.vivos:
+            mensaje += f"\n💰 Tus fichas: {t.fichas[user_id]} (mesa {t.sentado.get(user_id, '-')})"
+        await update.message.reply_text(mensaje)
+    
+    else:
+        abiertos = [x for x in torneos.values() if not x.terminado()]
+        mensaje = ("Uso:\n"
+                   "/torneo crear\n"
+                   "/torneo unirse [número]\n"
+                   "/torneo empezar [número]\n"
+                   "/torneo cancelar [número]\n"
+                   "/torneo ver [número]\n")
+        if abiertos:
+            mensaje += "\n🏆 **Torneos:**\n" + "".join(
+                f"• Torneo {x.id}: {len(x.nombres)} jugadores ({x.estado})\n" for x in abiertos)
+        await update.message.reply_text(mensaje)
+
+# Comando /debug_trace (solo administradores: ADMIN_IDS)
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()}
+
+async def debug_trace(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if perfil.registro_trazas is None:
+        await update.message.reply_text("Trazas desactivadas. Arranca con POKER_TRACE=1")
+        return
+    
+    args = context.args
+    try:
+        n = int(args[0]) if args else 5
+    except ValueError:
+        n = -1
+    if n < 0:
+        await update.message.reply_text("Uso: /debug_trace [n] (de 1 a 20, 5 por defecto)")
+        return
+    n = min(max(1, n), 20)
+    trazas = perfil.registro_trazas.ultimas(n)
+    if not trazas:
+        await update.message.reply_text("Todavía no hay trazas")
+        return
+    
+    bloques = []
+    for traza in trazas:
+        etapas = "\n".join(f"  +{ms:.1f} ms {etapa}" for etapa, ms in traza['etapas'])
+        bloques.append(f"#{traza['id']} {traza['accion']} (usuario {traza['user_id']}): {traza['total_ms']:.1f} ms\n{etapas}")
+    await update.message.reply_text("\n\n".join(bloques)[-4000:])
+
+CONFIRMACIONES = {
+    motor.PASAR: "✅ Pasaste tu turno",
+    motor.RETIRARSE: "🏳️ Te retiraste de la mano"
+}
+
+# La mesa avanzó (quizá en otro worker) entre el botón y la escritura
+async def mesa_cambiada(query):
+    if query:
+        await query.edit_message_text("⌛ La mesa cambió: usa los botones del último mensaje")
+
+# Aplicar una acción del jugador en turno (botón o tiempo agotado) a través del motor
+# sobre la versión de la mesa que vio (la del botón o la del reloj)
+async def jugar_accion(room_id, user_id, accion, cantidad, version, context, query=None):
+    cargado = cargar_mesa(room_id)
+    perfil.marcar('lectura BD')
+    if not cargado:
+        return False
+    players, m, room = cargado
+    if room['state_version'] != version:
+        await mesa_cambiada(query)
+        return False
+    
+    asiento = m.turno[0]
+    if not 0 <= asiento < len(players) or players[asiento] != str(user_id):
+        return False
+    
+    por_igualar = motor.por_igualar(m, 0, asiento)
+    try:
+        pagado = motor.aplicar(m, 0, asiento, accion, cantidad)
+    except motor.JugadaInvalida as e:
+        cola_salida.encolar_info(context.bot, int(user_id), f"❌ {e}")
+        return False
+    
+    # Quitar fichas al jugador; si otro worker movió la mesa entretanto no se cobra nada
+    try:
+        with almacen.transaccion():
+            guardar_mesa(room_id, players, m, version)
+            pagar_en_mesa(room_id, [(user_id, -pagado)], accion)
+    except SalaCambiada:
+        await mesa_cambiada(query)
+        return False
+    perfil.marcar('estado guardado')
+    
+    if query:
+        if accion == motor.SUBIR:
+            await query.edit_message_text(f"✅ Subiste la apuesta a {m.apuesta_actual[0]} fichas")
+        elif accion == motor.IGUALAR:
+            await query.edit_message_text(f"✅ Igualaste la apuesta de {por_igualar} fichas")
+        else:
+            await query.edit_message_text(CONFIRMACIONES[accion])
+    
+    # Si todos se retiraron no hace falta mostrar la mesa
+    if motor.ultimo_en_pie(m, 0) >= 0:
+        await avanzar_ronda(room_id, context)
+        return True
+    
+    # Actualizar mesa para TODOS con botones
+    await enviar_mesa_con_botones(room_id, context, user_id)
+    
+    # Verificar si ronda completa
+    await verificar_ronda_completa(room_id, context)
+    return True
+
+# Callbacks ya vistos: por id de callback y por (usuario, sala, versión del estado)
+CALLBACK_DEDUP_TTL = float(os.getenv('CALLBACK_DEDUP_TTL', '30'))
+ACCIONES_JUEGO = ('raise_', 'call_', 'check_', 'fold_')
+
+class CacheIdempotencia:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._vistos = OrderedDict()
+
+    # Devuelve True si la clave ya estaba; si no, la registra
+    def visto(self, clave):
+        ahora = time.monotonic()
+        while self._vistos and next(iter(self._vistos.values())) < ahora:
+            self._vistos.popitem(last=False)
+        if clave in self._vistos:
+            return True
+        self._vistos[clave] = ahora + self.ttl
+        return False
+
+    def olvidar(self, clave):
+        self._vistos.pop(clave, None)
+
+callbacks_vistos = CacheIdempotencia(CALLBACK_DEDUP_TTL)
+
+# Traza por pulsación cuando POKER_TRACE=1
+def trazar_boton(handler):
+    async def envoltura(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if perfil.registro_trazas is None:
+            return await handler(update, context)
+        query = update.callback_query
+        traza = perfil.registro_trazas.empezar(query.data, query.from_user.id)
+        token = perfil.traza_actual.set(traza)
+        try:
+            return await handler(update, context)
+        finally:
+            perfil.traza_actual.reset(token)
+            traza.cerrar()
+    return envoltura
 
 # Manejar acciones del juego CORREGIDO
+@trazar_boton
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    
     data = query.data
     user_id = query.from_user.id
     
+    # Reentregas del mismo callback
+    if callbacks_vistos.visto(('id', query.id)):
+        await query.answer()
+        return
+    
+    # Toques repetidos o fuera de turno: se responden sin tocar la base ni la mesa
+    clave_accion = None
+    if data.startswith(ACCIONES_JUEGO):
+        parts = data.split('_')
+        room_id = int(parts[1])
+        # Botón de un mensaje anterior: la mesa ya cambió desde que se pintó. Antes de
+        # rechazarlo se relee la fila, por si la cambió otro worker y la caché va por detrás
+        if len(parts) >= 3 and int(parts[2]) != version_sala(room_id):
+            refrescar_estado(room_id)
+        if len(parts) < 3 or int(parts[2]) != version_sala(room_id):
+            await query.answer("⌛ La mesa cambió: usa los botones del último mensaje", show_alert=True)
+            return
+        turno = turnos_sala.get(room_id)
+        if turno is not None and turno != str(user_id):
+            await query.answer("⏳ No es tu turno", show_alert=True)
+            return
+        clave_accion = ('accion', user_id, room_id, version_sala(room_id))
+        if callbacks_vistos.visto(clave_accion):
+            await query.answer("⏳ Acción ya recibida", show_alert=True)
+            return
+    
+    await query.answer()
+    perfil.marcar('respuesta al callback')
+    
     if data.startswith('view_'):
         room_id = data.split('_')[1]
         mensaje = await mostrar_mesa(room_id, context)
@@ -711,168 +1773,45 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith('chips_'):
         room_id = data.split('_')[1]
-        conn = sqlite3.connect('poker.db')
-        c = conn.cursor()
-        c.execute("SELECT username, chips FROM users WHERE user_id=?", (user_id,))
-        user = c.fetchone()
+        user = obtener_usuario(user_id)
         if user:
             await query.edit_message_text(f"💰 {user[0]}, tienes {user[1]} fichas")
-        conn.close()
     
-    elif data.startswith('raise_'):
+    elif data.startswith(ACCIONES_JUEGO):
         parts = data.split('_')
         room_id = parts[1]
-        cantidad = int(parts[2])
-        
-        conn = sqlite3.connect('poker.db')
-        c = conn.cursor()
-        
-        # Obtener estado actual
-        c.execute("SELECT pot, players, current_bet, player_actions FROM game_rooms WHERE room_id=?", (room_id,))
-        room = c.fetchone()
-        if not room:
-            conn.close()
-            return
-        
-        pot = room[0]
-        players = room[1].split(',') if room[1] else []
-        old_bet = room[2]
-        player_actions_str = room[3] or ""
-        
-        # Calcular aumento real
-        aumento = cantidad - old_bet
-        nuevo_pot = pot + aumento
-        nueva_apuesta = cantidad
-        
-        # Actualizar bote y apuesta
-        c.execute("UPDATE game_rooms SET pot=?, current_bet=? WHERE room_id=?", 
-                 (nuevo_pot, nueva_apuesta, room_id))
-        
-        # Quitar fichas al jugador
-        c.execute("UPDATE users SET chips = chips - ? WHERE user_id=?", (cantidad, user_id))
-        
-        # Cambiar turno
-        idx = players.index(str(user_id))
-        siguiente_idx = (idx + 1) % len(players)
-        siguiente = players[siguiente_idx]
-        
-        c.execute("UPDATE game_rooms SET current_turn=? WHERE room_id=?", (siguiente, room_id))
+        accion = {'raise': motor.SUBIR, 'call': motor.IGUALAR, 'check': motor.PASAR, 'fold': motor.RETIRARSE}[parts[0]]
+        cantidad = int(parts[3]) if accion == motor.SUBIR else 0
         
-        # Resetear acciones (porque subió la apuesta)
-        c.execute("UPDATE game_rooms SET player_actions=? WHERE room_id=?", (str(user_id), room_id))
-        
-        conn.commit()
-        conn.close()
-        
-        await query.edit_message_text(f"✅ Subiste la apuesta a {cantidad} fichas")
-        # Actualizar mesa para TODOS con botones
-        await enviar_mesa_con_botones(room_id, context, user_id)
-    
-    elif data.startswith('call_'):
-        room_id = data.split('_')[1]
-        
-        conn = sqlite3.connect('poker.db')
-        c = conn.cursor()
-        
-        c.execute("SELECT current_bet, pot, players, player_actions FROM game_rooms WHERE room_id=?", (room_id,))
-        room = c.fetchone()
-        if not room:
-            conn.close()
-            return
-        
-        current_bet = room[0]
-        pot = room[1]
-        players = room[2].split(',') if room[2] else []
-        player_actions_str = room[3] or ""
-        
-        # Igualar apuesta
-        nuevo_pot = pot + current_bet
-        c.execute("UPDATE game_rooms SET pot=? WHERE room_id=?", (nuevo_pot, room_id))
-        c.execute("UPDATE users SET chips = chips - ? WHERE user_id=?", (current_bet, user_id))
-        
-        # Cambiar turno
-        idx = players.index(str(user_id))
-        siguiente_idx = (idx + 1) % len(players)
-        siguiente = players[siguiente_idx]
-        
-        c.execute("UPDATE game_rooms SET current_turn=? WHERE room_id=?", (siguiente, room_id))
-        
-        # Agregar jugador a acciones
-        acciones_lista = player_actions_str.split(',') if player_actions_str else []
-        acciones_lista.append(str(user_id))
-        c.execute("UPDATE game_rooms SET player_actions=? WHERE room_id=?", (','.join(acciones_lista), room_id))
-        
-        conn.commit()
-        conn.close()
-        
-        await query.edit_message_text(f"✅ Igualaste la apuesta de {current_bet} fichas")
-        # Actualizar mesa para TODOS con botones
-        await enviar_mesa_con_botones(room_id, context, user_id)
-        
-        # Verificar si ronda completa
-        await verificar_ronda_completa(room_id, context)
-    
-    elif data.startswith('check_'):
-        room_id = data.split('_')[1]
-        
-        conn = sqlite3.connect('poker.db')
-        c = conn.cursor()
-        
-        c.execute("SELECT players, player_actions FROM game_rooms WHERE room_id=?", (room_id,))
-        room = c.fetchone()
-        if not room:
-            conn.close()
-            return
-        
-        players = room[0].split(',') if room[0] else []
-        player_actions_str = room[1] or ""
-        
-        # Cambiar turno
-        idx = players.index(str(user_id))
-        siguiente_idx = (idx + 1) % len(players)
-        siguiente = players[siguiente_idx]
-        
-        c.execute("UPDATE game_rooms SET current_turn=? WHERE room_id=?", (siguiente, room_id))
-        
-        # Agregar jugador a acciones
-        acciones_lista = player_actions_str.split(',') if player_actions_str else []
-        acciones_lista.append(str(user_id))
-        c.execute("UPDATE game_rooms SET player_actions=? WHERE room_id=?", (','.join(acciones_lista), room_id))
-        
-        conn.commit()
-        conn.close()
-        
-        await query.edit_message_text("✅ Pasaste tu turno")
-        # Actualizar mesa para TODOS con botones
-        await enviar_mesa_con_botones(room_id, context, user_id)
-        
-        # Verificar si ronda completa
-        await verificar_ronda_completa(room_id, context)
-    
-    elif data.startswith('fold_'):
-        room_id = data.split('_')[1]
-        
-        conn = sqlite3.connect('poker.db')
-        c = conn.cursor()
-        
-        # Agregar a lista de retirados
-        c.execute("SELECT player_folded FROM game_rooms WHERE room_id=?", (room_id,))
-        folded_str = c.fetchone()[0] or ""
-        folded = folded_str.split(',') if folded_str else []
-        folded.append(str(user_id))
-        
-        c.execute("UPDATE game_rooms SET player_folded=? WHERE room_id=?", 
-                 (','.join(folded), room_id))
-        
-        conn.commit()
-        conn.close()
-        
-        await query.edit_message_text("🏳️ Te retiraste de la mano")
-        await avanzar_ronda(room_id, context)
+        # Una jugada rechazada no cuenta como repetida: puede elegir otra
+        if not await jugar_accion(room_id, user_id, accion, cantidad, int(parts[2]), context, query):
+            callbacks_vistos.olvidar(clave_accion)
+
+# Arranque: cada etapa con su instante; se informa al conectar con Telegram
+STARTUP_TARGET_MS = int(os.getenv('STARTUP_TARGET_MS', '3000'))
+etapas_arranque = [('inicio', ARRANQUE)]
+
+def marcar_arranque(etapa):
+    etapas_arranque.append((etapa, time.perf_counter()))
+
+async def arranque_listo(application):
+    marcar_arranque('Telegram')
+    total = (etapas_arranque[-1][1] - ARRANQUE) * 1000
+    desglose = ", ".join(f"{etapa} {(t - anterior) * 1000:.0f}"
+                         for (_, anterior), (etapa, t) in zip(etapas_arranque, etapas_arranque[1:]))
+    logger.info(f"🚀 Listo en {total:.0f} ms ({desglose})")
+    if total > STARTUP_TARGET_MS:
+        logger.warning(f"Arranque por encima del objetivo de {STARTUP_TARGET_MS} ms")
 
 def main():
-    # Inicializar base de datos
+    marcar_arranque('importaciones')
+    
+    # Perfilado y trazas opcionales
+    perfil.configurar()
+    
+    # Inicializar base de datos (sin DDL si el esquema ya está en su versión)
     init_db()
+    marcar_arranque('esquema')
     
     # Obtener token
     TOKEN = os.getenv('BOT_TOKEN')
@@ -881,7 +1820,7 @@ def main():
         return
     
     # Crear aplicación
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_init(arranque_listo).build()
     
     # Añadir handlers
     application.add_handler(CommandHandler("start", start))
@@ -890,11 +1829,27 @@ def main():
     application.add_handler(CommandHandler("crear_sala", crear_sala))
     application.add_handler(CommandHandler("salas", salas))
     application.add_handler(CommandHandler("chips", chips))
+    application.add_handler(CommandHandler("ranking", ranking_cmd))
+    application.add_handler(CommandHandler("mirar", mirar))
+    application.add_handler(CommandHandler("torneo", torneo_cmd))
+    application.add_handler(CommandHandler("debug_trace", debug_trace))
     application.add_handler(CallbackQueryHandler(button_handler))
     
+    # Reloj único para los tiempos de turno de todas las mesas
+    application.job_queue.run_repeating(reloj_turnos, interval=TIMER_TICK, first=TIMER_TICK)
+    application.job_queue.run_once(reanudar_mesas, 0)
+    
+    # Mantenimiento periódico de salas y base de datos
+    application.job_queue.run_repeating(mantenimiento, interval=MAINT_INTERVAL, first=MAINT_INTERVAL)
+    
+    marcar_arranque('aplicación')
+    
     # Iniciar bot
     logger.info("🤖 Bot de Poker TEXAS HOLD'EM COMPLETO iniciado...")
     application.run_polling()
+    perfil.detener()
+    almacen.cerrar()
+    registro.detener()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,331 @@
+# Motor de juego sin E/S: reglas de apuestas, turnos y calles de Texas Hold'em.
+# El estado de muchas mesas vive en arrays planos (una fila por mesa), así los
+# handlers de Telegram usan una mesa suelta y el modo por lotes simula miles a la vez.
+import random
+import time
+from array import array
+
+MAX_ASIENTOS = 9
+TODOS_ASIENTOS = (1 << MAX_ASIENTOS) - 1
+
+RONDAS = ['preflop', 'flop', 'turn', 'river', 'showdown']
+SHOWDOWN = RONDAS.index('showdown')
+CARTAS_POR_CALLE = {'flop': 3, 'turn': 1, 'river': 1}
+
+PASAR = 'check'
+IGUALAR = 'call'
+SUBIR = 'raise'
+RETIRARSE = 'fold'
+
+class JugadaInvalida(Exception):
+    pass
+
+# Primer asiento de la máscara estrictamente después de `asiento` (en círculo), o -1
+def siguiente_en(mascara, asiento):
+    if not mascara:
+        return -1
+    desplazamiento = asiento + 1
+    rotada = ((mascara >> desplazamiento) | (mascara << (MAX_ASIENTOS - desplazamiento))) & TODOS_ASIENTOS
+    return (desplazamiento + (rotada & -rotada).bit_length() - 1) % MAX_ASIENTOS
+
+def contar(mascara):
+    return bin(mascara).count('1')
+
+# Estado de n mesas; las columnas por asiento usan el índice mesa * MAX_ASIENTOS + asiento
+class Mesas:
+    def __init__(self, n_mesas):
+        self.n = n_mesas
+        total = n_mesas * MAX_ASIENTOS
+        self.fichas = array('q', bytes(8 * total))
+        self.apuestas = array('q', bytes(8 * total))
+        self.aportes = array('q', bytes(8 * total))
+        self.ocupados = array('H', bytes(2 * n_mesas))
+        self.retirados = array('H', bytes(2 * n_mesas))
+        self.all_in = array('H', bytes(2 * n_mesas))
+        self.actuaron = array('H', bytes(2 * n_mesas))
+        self.boton = array('b', bytes(n_mesas))
+        self.turno = array('b', bytes(n_mesas))
+        self.ronda = array('b', bytes(n_mesas))
+        self.bote = array('q', bytes(8 * n_mesas))
+        self.apuesta_actual = array('q', bytes(8 * n_mesas))
+
+def activos(m, t):
+    return m.ocupados[t] & ~m.retirados[t]
+
+def pueden_actuar(m, t):
+    return m.ocupados[t] & ~m.retirados[t] & ~m.all_in[t]
+
+# Asiento del único jugador que no se retiró, o -1
+def ultimo_en_pie(m, t):
+    vivos = activos(m, t)
+    if vivos and vivos & (vivos - 1) == 0:
+        return vivos.bit_length() - 1
+    return -1
+
+# La calle se cierra si queda uno en pie, si todos los que pueden actuar ya actuaron
+# o si solo uno tiene fichas y no debe nada (no tiene contra quién apostar)
+def calle_terminada(m, t):
+    if ultimo_en_pie(m, t) >= 0:
+        return True
+    pendientes = pueden_actuar(m, t)
+    if pendientes & ~m.actuaron[t] == 0:
+        return True
+    return contar(pendientes) == 1 and por_igualar(m, t, pendientes.bit_length() - 1) <= 0
+
+# Siguiente asiento en turno tras `asiento`, o -1 si la calle ya está cerrada
+def _siguiente_turno(m, t, asiento):
+    if calle_terminada(m, t):
+        return -1
+    return siguiente_en(pueden_actuar(m, t), asiento)
+
+# Ciega pequeña y grande (en mano a mano el botón pone la pequeña)
+def ciegas(m, t):
+    ocupados = m.ocupados[t]
+    if contar(ocupados) == 2:
+        pequena = m.boton[t]
+    else:
+        pequena = siguiente_en(ocupados, m.boton[t])
+    return pequena, siguiente_en(ocupados, pequena)
+
+def mover_boton(m, t):
+    m.boton[t] = siguiente_en(m.ocupados[t], m.boton[t])
+
+# Mueve fichas del jugador al bote (como mucho lo que le queda) y devuelve lo pagado
+def _pagar(m, t, asiento, cantidad):
+    i = t * MAX_ASIENTOS + asiento
+    pagado = min(cantidad, m.fichas[i])
+    m.fichas[i] -= pagado
+    m.apuestas[i] += pagado
+    m.aportes[i] += pagado
+    m.bote[t] += pagado
+    if m.fichas[i] == 0:
+        m.all_in[t] |= 1 << asiento
+    return pagado
+
+def nueva_mano(m, t, fichas, boton, ciega_pequena, ciega_grande):
+    base = t * MAX_ASIENTOS
+    for asiento in range(MAX_ASIENTOS):
+        m.fichas[base + asiento] = fichas[asiento] if asiento < len(fichas) else 0
+        m.apuestas[base + asiento] = 0
+        m.aportes[base + asiento] = 0
+    m.ocupados[t] = (1 << len(fichas)) - 1
+    m.retirados[t] = 0
+    m.all_in[t] = 0
+    m.actuaron[t] = 0
+    m.boton[t] = boton if boton < len(fichas) else 0
+    m.ronda[t] = 0
+    m.bote[t] = 0
+
+    pequena, grande = ciegas(m, t)
+    _pagar(m, t, pequena, ciega_pequena)
+    _pagar(m, t, grande, ciega_grande)
+    m.apuesta_actual[t] = ciega_grande
+    m.turno[t] = _siguiente_turno(m, t, grande)
+
+# Lo que le falta a un asiento para igualar
+def por_igualar(m, t, asiento):
+    return m.apuesta_actual[t] - m.apuestas[t * MAX_ASIENTOS + asiento]
+
+# Aplica la acción del jugador en turno, devuelve las fichas que pagó
+def aplicar(m, t, asiento, accion, cantidad=0):
+    if m.ronda[t] == SHOWDOWN or m.turno[t] < 0 or asiento != m.turno[t] or calle_terminada(m, t):
+        raise JugadaInvalida("No es tu turno")
+    bit = 1 << asiento
+    debe = por_igualar(m, t, asiento)
+    pagado = 0
+
+    if accion == PASAR:
+        if debe > 0:
+            raise JugadaInvalida(f"No puedes pasar: debes igualar {debe} fichas")
+        m.actuaron[t] |= bit
+    elif accion == IGUALAR:
+        pagado = _pagar(m, t, asiento, debe)
+        m.actuaron[t] |= bit
+    elif accion == SUBIR:
+        if cantidad <= 0:
+            raise JugadaInvalida("Cantidad inválida")
+        pagado = _pagar(m, t, asiento, debe + cantidad)
+        apuesta = m.apuestas[t * MAX_ASIENTOS + asiento]
+        if apuesta > m.apuesta_actual[t]:
+            # La subida obliga a actuar de nuevo a todos los demás
+            m.apuesta_actual[t] = apuesta
+            m.actuaron[t] = bit
+        else:
+            m.actuaron[t] |= bit
+    elif accion == RETIRARSE:
+        m.retirados[t] |= bit
+        m.actuaron[t] |= bit
+    else:
+        raise JugadaInvalida(f"Acción desconocida: {accion}")
+
+    m.turno[t] = _siguiente_turno(m, t, asiento)
+    return pagado
+
+# Pasa a la siguiente calle y devuelve su nombre
+def siguiente_calle(m, t):
+    base = t * MAX_ASIENTOS
+    for asiento in range(MAX_ASIENTOS):
+        m.apuestas[base + asiento] = 0
+    m.apuesta_actual[t] = 0
+    m.actuaron[t] = 0
+    m.ronda[t] = min(m.ronda[t] + 1, SHOWDOWN)
+    if m.ronda[t] == SHOWDOWN:
+        m.turno[t] = -1
+    else:
+        m.turno[t] = _siguiente_turno(m, t, m.boton[t])
+    return RONDAS[m.ronda[t]]
+
+# Reparte el bote (con botes laterales) según la fuerza de cada mano; mayor gana.
+# Devuelve (premios, devoluciones) por asiento y suma ambos a las fichas de la mesa:
+# las devoluciones son lo apostado que nadie igualó, que no es un bote ganado.
+def repartir_bote(m, t, fuerzas):
+    base = t * MAX_ASIENTOS
+    premios = [0] * MAX_ASIENTOS
+    devoluciones = [0] * MAX_ASIENTOS
+    vivos = activos(m, t)
+    ultimo = ultimo_en_pie(m, t)
+
+    if ultimo >= 0:
+        premios[ultimo] = m.bote[t]
+    else:
+        aportes = [m.aportes[base + a] for a in range(MAX_ASIENTOS)]
+        niveles = sorted(set(x for a, x in enumerate(aportes) if x and vivos >> a & 1))
+        anterior = 0
+        for nivel in niveles:
+            bote = sum(min(x, nivel) - min(x, anterior) for x in aportes)
+            candidatos = [a for a in range(MAX_ASIENTOS) if vivos >> a & 1 and aportes[a] >= nivel]
+            # Tramo que solo puso un asiento: no lo disputó nadie
+            if sum(1 for x in aportes if x > anterior) == 1:
+                devoluciones[candidatos[0]] += bote
+                anterior = nivel
+                continue
+            mejor = max(fuerzas[a] for a in candidatos)
+            ganadores = [a for a in candidatos if fuerzas[a] == mejor]
+            # Las fichas sobrantes van al primer ganador a la izquierda del botón
+            ganadores.sort(key=lambda a: (a - m.boton[t] - 1) % MAX_ASIENTOS)
+            parte, resto = divmod(bote, len(ganadores))
+            for a in ganadores:
+                premios[a] += parte
+            premios[ganadores[0]] += resto
+            anterior = nivel
+        # Lo aportado por encima del último nivel vivo vuelve a quien lo puso
+        for a, x in enumerate(aportes):
+            if x > anterior:
+                devoluciones[a] += x - anterior
+
+    for a in range(MAX_ASIENTOS):
+        m.fichas[base + a] += premios[a] + devoluciones[a]
+        m.apuestas[base + a] = 0
+        m.aportes[base + a] = 0
+    m.bote[t] = 0
+    m.ronda[t] = SHOWDOWN
+    m.turno[t] = -1
+    return premios, devoluciones
+
+# ---------- Simulación por lotes ----------
+
+def estrategia_pasiva(m, t, asiento, rng):
+    return (PASAR, 0) if por_igualar(m, t, asiento) == 0 else (IGUALAR, 0)
+
+def estrategia_agresiva(m, t, asiento, rng):
+    if rng.random() < 0.3:
+        return SUBIR, rng.choice((10, 50))
+    return estrategia_pasiva(m, t, asiento, rng)
+
+def estrategia_aleatoria(m, t, asiento, rng):
+    r = rng.random()
+    if r < 0.15:
+        return RETIRARSE, 0
+    if r < 0.35:
+        return SUBIR, rng.choice((10, 20, 50, 100))
+    return estrategia_pasiva(m, t, asiento, rng)
+
+ESTRATEGIAS = {
+    'pasiva': estrategia_pasiva,
+    'agresiva': estrategia_agresiva,
+    'aleatoria': estrategia_aleatoria,
+}
+
+# Invariantes que deben cumplirse tras cada acción
+def verificar(m, t, total_fichas):
+    base = t * MAX_ASIENTOS
+    fichas = sum(m.fichas[base:base + MAX_ASIENTOS])
+    if fichas + m.bote[t] != total_fichas:
+        raise AssertionError(f"Mesa {t}: fichas no conservadas ({fichas} + {m.bote[t]} != {total_fichas})")
+    if m.bote[t] != sum(m.aportes[base:base + MAX_ASIENTOS]):
+        raise AssertionError(f"Mesa {t}: el bote no coincide con los aportes")
+    turno = m.turno[t]
+    if turno >= 0 and not pueden_actuar(m, t) >> turno & 1:
+        raise AssertionError(f"Mesa {t}: turno en asiento {turno} que no puede actuar")
+    if turno < 0 and not calle_terminada(m, t) and m.ronda[t] != SHOWDOWN:
+        raise AssertionError(f"Mesa {t}: nadie en turno con la calle abierta")
+    if turno >= 0 and (calle_terminada(m, t) or m.ronda[t] == SHOWDOWN):
+        raise AssertionError(f"Mesa {t}: turno en asiento {turno} con la calle cerrada")
+
+# Simula n_manos en cada una de n_mesas, avanzando todas las mesas a la vez
+def simular(n_mesas, n_manos, jugadores=2, estrategias=('aleatoria',), fichas_iniciales=1000,
+            ciega_pequena=10, ciega_grande=20, semilla=None, comprobar=True):
+    rng = random.Random(semilla)
+    m = Mesas(n_mesas)
+    funciones = [ESTRATEGIAS[e] for e in estrategias]
+    total = jugadores * fichas_iniciales
+    pilas = [[fichas_iniciales] * jugadores for _ in range(n_mesas)]
+    botones = [0] * n_mesas
+    manos = acciones = 0
+    inicio = time.perf_counter()
+
+    for _ in range(n_manos):
+        for t in range(n_mesas):
+            # Recompra cuando alguien se queda sin fichas
+            if min(pilas[t]) == 0:
+                pilas[t] = [fichas_iniciales] * jugadores
+            nueva_mano(m, t, pilas[t], botones[t], ciega_pequena, ciega_grande)
+
+        abiertas = list(range(n_mesas))
+        while abiertas:
+            siguen = []
+            for t in abiertas:
+                if calle_terminada(m, t):
+                    if ultimo_en_pie(m, t) >= 0 or siguiente_calle(m, t) == 'showdown':
+                        repartir_bote(m, t, [rng.random() for _ in range(MAX_ASIENTOS)])
+                        if comprobar:
+                            verificar(m, t, total)
+                        base = t * MAX_ASIENTOS
+                        pilas[t] = list(m.fichas[base:base + jugadores])
+                        mover_boton(m, t)
+                        botones[t] = m.boton[t]
+                        manos += 1
+                        continue
+                else:
+                    asiento = m.turno[t]
+                    accion, cantidad = funciones[asiento % len(funciones)](m, t, asiento, rng)
+                    try:
+                        aplicar(m, t, asiento, accion, cantidad)
+                    except JugadaInvalida:
+                        aplicar(m, t, asiento, RETIRARSE)
+                    acciones += 1
+                    if comprobar:
+                        verificar(m, t, total)
+                siguen.append(t)
+            abiertas = siguen
+
+    segundos = time.perf_counter() - inicio
+    return {'manos': manos, 'acciones': acciones, 'segundos': segundos,
+            'manos_por_segundo': manos / segundos if segundos else 0.0}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulación por lotes del motor de poker")
+    parser.add_argument('--mesas', type=int, default=1000)
+    parser.add_argument('--manos', type=int, default=100)
+    parser.add_argument('--jugadores', type=int, default=2)
+    parser.add_argument('--estrategias', default='aleatoria')
+    parser.add_argument('--semilla', type=int, default=None)
+    parser.add_argument('--sin-comprobar', action='store_true')
+    args = parser.parse_args()
+
+    resultado = simular(args.mesas, args.manos, args.jugadores, args.estrategias.split(','),
+                        semilla=args.semilla, comprobar=not args.sin_comprobar)
+    print(f"{resultado['manos']} manos, {resultado['acciones']} acciones en {resultado['segundos']:.2f}s "
+          f"({resultado['manos_por_segundo']:.0f} manos/s)")
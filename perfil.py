@@ -0,0 +1,159 @@
+# Perfilado opcional (por entorno):
+# - POKER_PROFILE=1: un hilo muestrea las pilas de los demás hilos cada PROFILE_INTERVAL_MS
+#   y cada PROFILE_FLUSH_SECS vuelca las cuentas en formato colapsado (una línea
+#   "a;b;c N" por pila), listo para flamegraph.pl o speedscope.
+# - POKER_TRACE=1: cada pulsación de botón lleva una traza con la marca de tiempo de cada
+#   etapa (lectura, estado, render, envíos...) que se añade a TRACE_FILE como JSON por línea.
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+import contextvars
+from collections import Counter, deque
+
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '10'))
+PROFILE_FLUSH_SECS = float(os.getenv('PROFILE_FLUSH_SECS', '60'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'perfiles')
+TRACE_FILE = os.getenv('TRACE_FILE', 'trazas.jsonl')
+TRACE_KEEP = int(os.getenv('TRACE_KEEP', '500'))
+
+def _pila(frame):
+    marcos = []
+    while frame is not None:
+        codigo = frame.f_code
+        marcos.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(marcos))
+
+# Muestreador de pilas en un hilo aparte; no toca el bucle de asyncio
+class Muestreador:
+    def __init__(self, intervalo, volcado, directorio):
+        self.intervalo = intervalo
+        self.volcado = volcado
+        self.directorio = directorio
+        self.cuentas = Counter()
+        self.muestras = 0
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def iniciar(self):
+        os.makedirs(self.directorio, exist_ok=True)
+        self._hilo = threading.Thread(target=self._bucle, name='muestreador', daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join()
+        self.volcar()
+
+    def _bucle(self):
+        propio = threading.get_ident()
+        siguiente_volcado = time.monotonic() + self.volcado
+        while not self._parar.wait(self.intervalo):
+            for hilo, frame in sys._current_frames().items():
+                if hilo != propio:
+                    self.cuentas[_pila(frame)] += 1
+            self.muestras += 1
+            if time.monotonic() >= siguiente_volcado:
+                self.volcar()
+                siguiente_volcado = time.monotonic() + self.volcado
+
+    # Un fichero por periodo: perfiles/perfil-AAAAMMDD-HHMMSS.folded
+    def volcar(self):
+        if not self.cuentas:
+            return None
+        cuentas, self.cuentas = self.cuentas, Counter()
+        ruta = os.path.join(self.directorio, time.strftime('perfil-%Y%m%d-%H%M%S.folded'))
+        with open(ruta, 'a') as f:
+            for pila, n in cuentas.most_common():
+                f.write(f"{pila} {n}\n")
+        return ruta
+
+# Traza de una acción: etapas con milisegundos desde que llegó el callback.
+# Se guarda cuando la acción terminó y salieron todos los envíos que generó.
+class Traza:
+    __slots__ = ('registro', 'id', 'accion', 'user_id', 'inicio', 't0', 'etapas', '_pendientes', '_cerrada')
+
+    def __init__(self, registro, traza_id, accion, user_id):
+        self.registro = registro
+        self.id = traza_id
+        self.accion = accion
+        self.user_id = user_id
+        self.inicio = time.time()
+        self.t0 = time.perf_counter()
+        self.etapas = [('callback recibido', 0.0)]
+        self._pendientes = 0
+        self._cerrada = False
+
+    def marcar(self, etapa):
+        self.etapas.append((etapa, round((time.perf_counter() - self.t0) * 1000, 2)))
+
+    # Un envío encolado que pertenece a esta traza
+    def retener(self):
+        self._pendientes += 1
+
+    def soltar(self, etapa):
+        self.marcar(etapa)
+        self._pendientes -= 1
+        self._terminar()
+
+    def cerrar(self):
+        self.marcar('fin del handler')
+        self._cerrada = True
+        self._terminar()
+
+    def _terminar(self):
+        if self._cerrada and self._pendientes <= 0:
+            self._cerrada = False
+            self.registro.guardar(self)
+
+    def como_dict(self):
+        return {'id': self.id, 'accion': self.accion, 'user_id': self.user_id, 'inicio': self.inicio,
+                'total_ms': self.etapas[-1][1], 'etapas': self.etapas}
+
+traza_actual = contextvars.ContextVar('traza_actual', default=None)
+
+# Marca una etapa en la traza de la acción en curso (nada si no se está trazando)
+def marcar(etapa):
+    traza = traza_actual.get()
+    if traza is not None:
+        traza.marcar(etapa)
+
+class RegistroTrazas:
+    def __init__(self, ruta, guardar_recientes):
+        self.ruta = ruta
+        self.recientes = deque(maxlen=guardar_recientes)
+        self._ids = itertools.count(1)
+        self._fichero = None
+
+    def empezar(self, accion, user_id):
+        return Traza(self, next(self._ids), accion, user_id)
+
+    def guardar(self, traza):
+        datos = traza.como_dict()
+        self.recientes.append(datos)
+        if self._fichero is None:
+            self._fichero = open(self.ruta, 'a', buffering=1)
+        self._fichero.write(json.dumps(datos, ensure_ascii=False) + "\n")
+
+    def ultimas(self, n):
+        return list(self.recientes)[-n:] if n > 0 else []
+
+# Lo que esté activado por entorno (None si no)
+muestreador = None
+registro_trazas = None
+
+def configurar():
+    global muestreador, registro_trazas
+    if os.getenv('POKER_PROFILE') == '1' and muestreador is None:
+        muestreador = Muestreador(PROFILE_INTERVAL_MS / 1000, PROFILE_FLUSH_SECS, PROFILE_DIR)
+        muestreador.iniciar()
+    if os.getenv('POKER_TRACE') == '1' and registro_trazas is None:
+        registro_trazas = RegistroTrazas(TRACE_FILE, TRACE_KEEP)
+
+def detener():
+    if muestreador is not None:
+        muestreador.detener()
@@ -0,0 +1,133 @@
+# Registro sin bloquear el bucle de eventos: los handlers solo dejan el registro en
+# una cola y un hilo aparte lo formatea y lo escribe. Cada línea es un JSON con
+# room_id, user_id, action y la clase de error cuando vienen en `extra`.
+# Los errores repetidos (misma clase, misma sala) salen una vez por ventana de
+# LOG_AGGREGATE_SECS y al cerrarse la ventana una línea con cuántos se agruparon;
+# el hilo escritor cierra las ventanas vencidas aunque no llegue ningún registro más.
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import logging.handlers
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 2**20)))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '3'))
+LOG_AGGREGATE_SECS = float(os.getenv('LOG_AGGREGATE_SECS', '60'))
+
+CAMPOS = ('room_id', 'user_id', 'action', 'error', 'detalle', 'repetidos')
+
+# extra= para registrar un error: la clase agrupa, el texto acompaña
+def con_error(e, **campos):
+    return dict(campos, error=type(e).__name__, detalle=str(e))
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        datos = {'ts': round(record.created, 3), 'level': record.levelname, 'logger': record.name,
+                 'msg': record.getMessage()}
+        for campo in CAMPOS:
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                datos[campo] = valor
+        if record.exc_info:
+            datos.setdefault('error', record.exc_info[0].__name__)
+            datos['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+# Lado del bucle: agrega errores repetidos y encola sin formatear
+class ManejadorCola(logging.handlers.QueueHandler):
+    def __init__(self, cola, ventana):
+        super().__init__(cola)
+        self.ventana = ventana
+        # (error, room_id) -> [fin de la ventana, repetidos, logger, mensaje]
+        self._errores = {}
+        self._barrido = 0.0
+
+    # El texto y la traza se componen en el hilo escritor, no aquí
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        ahora = record.created
+        if ahora >= self._barrido:
+            self.vaciar(ahora)
+        error = getattr(record, 'error', None)
+        if error is not None:
+            clave = (error, getattr(record, 'room_id', None))
+            ventana = self._errores.get(clave)
+            if ventana is not None and ahora < ventana[0]:
+                ventana[1] += 1
+                return
+            self._errores[clave] = [ahora + self.ventana, 0, record.name, record.getMessage()]
+        super().emit(record)
+
+    # Cierra las ventanas vencidas con una línea de resumen si hubo repeticiones
+    # (desde el bucle al emitir o desde el hilo escritor: bajo el lock del manejador)
+    def vaciar(self, ahora):
+        with self.lock:
+            for clave, (fin, repetidos, nombre, mensaje) in list(self._errores.items()):
+                if fin > ahora:
+                    continue
+                del self._errores[clave]
+                if repetidos:
+                    error, room_id = clave
+                    super().emit(logging.makeLogRecord({
+                        'name': nombre, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                        'msg': f"{mensaje} (x{repetidos} más en {self.ventana:g}s)",
+                        'error': error, 'room_id': room_id, 'repetidos': repetidos}))
+            self._barrido = ahora + self.ventana
+
+# Hilo escritor: mientras la cola está en silencio revisa las ventanas de errores
+# cada segundo como mucho para que los resúmenes salgan a su hora
+class Escritor(logging.handlers.QueueListener):
+    def __init__(self, cola, destino, manejador):
+        super().__init__(cola, destino)
+        self.manejador = manejador
+        self.intervalo = max(min(manejador.ventana, 1.0), 0.1)
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.intervalo)
+            except queue.Empty:
+                if not block:
+                    raise
+                self.manejador.vaciar(time.time())
+
+manejador = None
+escritor = None
+
+def configurar():
+    global manejador, escritor
+    if manejador is not None:
+        return
+    if LOG_FILE:
+        destino = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                                       encoding='utf-8')
+    else:
+        destino = logging.StreamHandler(sys.stderr)
+    destino.setFormatter(FormatoJSON())
+
+    cola = queue.SimpleQueue()
+    manejador = ManejadorCola(cola, LOG_AGGREGATE_SECS)
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [manejador]
+    raiz.setLevel(LOG_LEVEL)
+    # httpx registra cada petición a Telegram en INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    escritor = Escritor(cola, destino, manejador)
+    escritor.start()
+
+def detener():
+    global manejador, escritor
+    if manejador is None:
+        return
+    manejador.vaciar(float('inf'))
+    escritor.stop()
+    manejador = escritor = None
@@ -0,0 +1,303 @@
+# Torneos multimesa sin E/S: inscripción, niveles de ciegas, eliminaciones y
+# reequilibrio incremental de mesas. Las mesas se agrupan en cubetas por número de
+# jugadores asignados, así la más llena y la más vacía se encuentran sin recorrer
+# todas; cada eliminación genera solo los movimientos necesarios y estos se aplican
+# cuando la mesa afectada está entre dos manos.
+import math
+import random
+import time
+
+# (ciega pequeña, ciega grande) por nivel
+NIVELES = [(10, 20), (15, 30), (25, 50), (50, 100), (75, 150), (100, 200), (150, 300),
+           (200, 400), (300, 600), (400, 800), (500, 1000), (700, 1400), (1000, 2000)]
+
+# Con mesas de 2 un campo impar deja siempre a alguien solo en una mesa; desde 3 el
+# reparto equilibrado sienta al menos a 2 en cada una
+MESA_MINIMA = 3
+
+class ErrorTorneo(Exception):
+    pass
+
+class Torneo:
+    def __init__(self, torneo_id, creador_id, tamano_mesa=6, fichas_iniciales=1500, niveles=NIVELES):
+        if tamano_mesa < MESA_MINIMA:
+            raise ErrorTorneo(f"Las mesas de torneo son de {MESA_MINIMA} jugadores o más")
+        self.id = torneo_id
+        self.creador_id = creador_id
+        self.tamano_mesa = tamano_mesa
+        self.fichas_iniciales = fichas_iniciales
+        self.niveles = niveles
+        self.nivel = 0
+        self.estado = 'registro'
+        self.nombres = {}
+        self.fichas = {}
+        self.vivos = set()
+        self.eliminados = []
+        # Mesa asignada a cada jugador (objetivo) y mesa donde está sentado de verdad
+        self.destino = {}
+        self.sentado = {}
+        self.asientos = {}
+        self.asignados = {}
+        self._cubetas = [set() for _ in range(tamano_mesa + 1)]
+        # Movimientos pendientes hasta que la mesa quede entre manos
+        self._salen = {}
+        self._entran = {}
+        self._sucias = set()
+        self.en_mano = set()
+        self.movimientos = 0
+
+    def inscribir(self, user_id, nombre):
+        if self.estado != 'registro':
+            raise ErrorTorneo("La inscripción está cerrada")
+        if user_id in self.nombres:
+            raise ErrorTorneo("Ya estás inscrito")
+        self.nombres[user_id] = nombre
+
+    def ciegas(self):
+        return self.niveles[min(self.nivel, len(self.niveles) - 1)]
+
+    # Devuelve True si había un nivel más
+    def subir_nivel(self):
+        if self.nivel + 1 >= len(self.niveles):
+            return False
+        self.nivel += 1
+        return True
+
+    def mesas_necesarias(self):
+        return max(math.ceil(len(self.vivos) / self.tamano_mesa), 1)
+
+    def terminado(self):
+        return self.estado == 'terminado'
+
+    def campeon(self):
+        return next(iter(self.vivos)) if len(self.vivos) == 1 else None
+
+    # Posición final de un jugador eliminado (1 = campeón)
+    def posicion(self, user_id):
+        if user_id in self.vivos:
+            return 1 if len(self.vivos) == 1 else None
+        return len(self.nombres) - self.eliminados.index(user_id)
+
+    # Sienta a los inscritos por turnos en las mesas dadas (tantas como mesas_necesarias)
+    def repartir(self, room_ids, rng=random):
+        jugadores = list(self.nombres)
+        rng.shuffle(jugadores)
+        self.vivos = set(jugadores)
+        self.fichas = {u: self.fichas_iniciales for u in jugadores}
+        for room_id in room_ids:
+            self.asientos[room_id] = []
+            self.asignados[room_id] = set()
+            self._cubetas[0].add(room_id)
+        for i, user_id in enumerate(jugadores):
+            room_id = room_ids[i % len(room_ids)]
+            self._asignar(user_id, room_id)
+            self.asientos[room_id].append(user_id)
+            self.sentado[user_id] = room_id
+            self._entran[room_id].discard(user_id)
+        self._sucias.clear()
+        self.movimientos = 0
+        self.estado = 'jugando'
+
+    def _sacar_de_cubeta(self, room_id):
+        self._cubetas[len(self.asignados[room_id])].discard(room_id)
+
+    def _poner_en_cubeta(self, room_id):
+        self._cubetas[len(self.asignados[room_id])].add(room_id)
+
+    def _mesa_menor(self):
+        for cubeta in self._cubetas:
+            if cubeta:
+                return next(iter(cubeta))
+        return None
+
+    def _mesa_mayor(self):
+        for cubeta in reversed(self._cubetas):
+            if cubeta:
+                return next(iter(cubeta))
+        return None
+
+    # Cambia la mesa asignada; si ya estaba sentado en otra, queda pendiente de salir
+    def _asignar(self, user_id, room_id):
+        anterior = self.destino.get(user_id)
+        if anterior is not None:
+            if anterior in self.asignados:
+                self._sacar_de_cubeta(anterior)
+                self.asignados[anterior].discard(user_id)
+                self._poner_en_cubeta(anterior)
+            self._entran.get(anterior, set()).discard(user_id)
+        self._sacar_de_cubeta(room_id)
+        self.asignados[room_id].add(user_id)
+        self._poner_en_cubeta(room_id)
+        self.destino[user_id] = room_id
+
+        actual = self.sentado.get(user_id)
+        if actual == room_id:
+            self._salen.get(actual, set()).discard(user_id)
+            return
+        if actual is not None:
+            self._salen.setdefault(actual, set()).add(user_id)
+            self._sucias.add(actual)
+        self._entran.setdefault(room_id, set()).add(user_id)
+        self._sucias.add(room_id)
+        self.movimientos += 1
+
+    def _eliminar(self, user_id):
+        self.vivos.discard(user_id)
+        self.eliminados.append(user_id)
+        room_id = self.destino.pop(user_id, None)
+        if room_id in self.asignados:
+            self._sacar_de_cubeta(room_id)
+            self.asignados[room_id].discard(user_id)
+            self._poner_en_cubeta(room_id)
+            self._entran.get(room_id, set()).discard(user_id)
+        sentado = self.sentado.pop(user_id, None)
+        if sentado is not None:
+            self.asientos[sentado].remove(user_id)
+            self._salen.get(sentado, set()).discard(user_id)
+            self._sucias.add(sentado)
+
+    # Rompe mesas sobrantes y nivela las demás (diferencia máxima de un jugador)
+    def reequilibrar(self):
+        while len(self.asignados) > self.mesas_necesarias():
+            rota = self._mesa_menor()
+            self._sacar_de_cubeta(rota)
+            jugadores = self.asignados.pop(rota)
+            self._entran.pop(rota, None)
+            for user_id in jugadores:
+                self.destino.pop(user_id)
+                self._asignar(user_id, self._mesa_menor())
+            self._sucias.add(rota)
+
+        while True:
+            mayor, menor = self._mesa_mayor(), self._mesa_menor()
+            if mayor is None or len(self.asignados[mayor]) - len(self.asignados[menor]) <= 1:
+                break
+            # Preferir a quien no esté en plena mano para que se mueva antes
+            candidatos = self.asignados[mayor]
+            user_id = next((u for u in candidatos if self.sentado.get(u) not in self.en_mano), next(iter(candidatos)))
+            self._asignar(user_id, menor)
+
+    def empezar_mano(self, room_id):
+        self.en_mano.add(room_id)
+
+    # Fin de mano en una mesa: elimina a los que se quedaron sin fichas, reequilibra y
+    # aplica los movimientos pendientes en las mesas libres.
+    # Devuelve (eliminados, {room_id: asientos} de las mesas que cambiaron, mesas cerradas)
+    def fin_mano(self, room_id):
+        self.en_mano.discard(room_id)
+        eliminados = [u for u in self.asientos.get(room_id, []) if self.fichas.get(u, 0) <= 0]
+        for user_id in eliminados:
+            self._eliminar(user_id)
+        if len(self.vivos) <= 1:
+            self.estado = 'terminado'
+            return eliminados, {}, list(self.asientos)
+        self.reequilibrar()
+        cambios, cerradas = self.sincronizar()
+        if eliminados and room_id in self.asientos:
+            cambios.setdefault(room_id, self.asientos[room_id])
+        return eliminados, cambios, cerradas
+
+    # Aplica salidas y entradas en las mesas que no están jugando una mano
+    def sincronizar(self):
+        cambios = {}
+        libres = [r for r in self._sucias if r not in self.en_mano]
+        for room_id in libres:
+            for user_id in self._salen.pop(room_id, ()):
+                self.asientos[room_id].remove(user_id)
+                del self.sentado[user_id]
+                cambios[room_id] = self.asientos[room_id]
+                # Si su nueva mesa también está libre entra en esta misma pasada
+                destino = self.destino[user_id]
+                if destino not in self.en_mano:
+                    libres.append(destino)
+        for room_id in dict.fromkeys(libres):
+            entran = [u for u in self._entran.get(room_id, ()) if u not in self.sentado]
+            for user_id in entran:
+                self._entran[room_id].discard(user_id)
+                self.asientos[room_id].append(user_id)
+                self.sentado[user_id] = room_id
+                cambios[room_id] = self.asientos[room_id]
+            if not self._salen.get(room_id) and not self._entran.get(room_id):
+                self._sucias.discard(room_id)
+
+        # Mesas rotas que ya se vaciaron
+        cerradas = [r for r in libres if r not in self.asignados and not self.asientos.get(r)]
+        for room_id in dict.fromkeys(cerradas):
+            self.asientos.pop(room_id, None)
+            self._sucias.discard(room_id)
+            cambios.pop(room_id, None)
+        return cambios, list(dict.fromkeys(cerradas))
+
+    # Invariantes tras cada fin de mano
+    def verificar(self):
+        tamanos = [len(a) for a in self.asignados.values()]
+        if tamanos and max(tamanos) - min(tamanos) > 1:
+            raise AssertionError(f"Mesas desequilibradas: {min(tamanos)}..{max(tamanos)}")
+        if len(self.vivos) > 1 and tamanos and min(tamanos) < 2:
+            raise AssertionError("Mesa asignada con un solo jugador")
+        if len(self.asignados) != self.mesas_necesarias():
+            raise AssertionError(f"{len(self.asignados)} mesas para {len(self.vivos)} jugadores")
+        if set(self.destino) != self.vivos:
+            raise AssertionError("Hay jugadores vivos sin mesa asignada")
+        if sum(len(c) for c in self._cubetas) != len(self.asignados):
+            raise AssertionError("Cubetas desincronizadas")
+        for user_id, room_id in self.sentado.items():
+            if user_id not in self.asientos[room_id]:
+                raise AssertionError(f"Jugador {user_id} sentado fuera de su mesa")
+
+# ---------- Simulación ----------
+
+# Todas las mesas juegan manos a la vez; al acabar cada ronda de manos unos cuantos
+# jugadores por mesa pierden todo. Mide el coste del reequilibrio con campos grandes.
+def simular(jugadores, tamano_mesa=9, eliminacion=0.08, semilla=None, comprobar=True):
+    rng = random.Random(semilla)
+    t = Torneo(1, 0, tamano_mesa)
+    for user_id in range(jugadores):
+        t.inscribir(user_id, f"J{user_id}")
+    t.repartir(list(range(1, math.ceil(jugadores / tamano_mesa) + 1)), rng)
+    if comprobar:
+        t.verificar()
+    rondas = manos = 0
+    inicio = time.perf_counter()
+
+    while not t.terminado():
+        mesas = [r for r, a in t.asientos.items() if len(a) >= 2]
+        if not mesas:
+            raise AssertionError("Ninguna mesa puede jugar con el torneo abierto")
+        for room_id in mesas:
+            t.empezar_mano(room_id)
+        rng.shuffle(mesas)
+        for room_id in mesas:
+            if t.terminado():
+                break
+            asientos = t.asientos[room_id]
+            # El bote de los que caen va a un superviviente de la mesa
+            caen = [u for u in asientos if rng.random() < eliminacion][:len(asientos) - 1]
+            ganador = next(u for u in asientos if u not in caen)
+            for user_id in caen:
+                t.fichas[ganador] += t.fichas[user_id]
+                t.fichas[user_id] = 0
+            t.fin_mano(room_id)
+            manos += 1
+            if comprobar and not t.terminado():
+                t.verificar()
+        rondas += 1
+
+    segundos = time.perf_counter() - inicio
+    return {'rondas': rondas, 'manos': manos, 'movimientos': t.movimientos, 'segundos': segundos,
+            'campeon': t.campeon()}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulación de un torneo multimesa")
+    parser.add_argument('--jugadores', type=int, default=5000)
+    parser.add_argument('--mesa', type=int, default=9)
+    parser.add_argument('--eliminacion', type=float, default=0.08)
+    parser.add_argument('--semilla', type=int, default=None)
+    parser.add_argument('--sin-comprobar', action='store_true')
+    args = parser.parse_args()
+
+    resultado = simular(args.jugadores, args.mesa, args.eliminacion, args.semilla, not args.sin_comprobar)
+    print(f"{resultado['manos']} manos en {resultado['rondas']} rondas, {resultado['movimientos']} movimientos "
+          f"en {resultado['segundos']:.2f}s (campeón: J{resultado['campeon']})")